@@ -0,0 +1,46 @@
+"""
+Compare the memory used by queued tasks as (coro, args, kwargs, meta,
+priority) tuples with a meta dict against Task records.
+
+    python benchmarks/task_memory.py [count]
+"""
+import sys
+import tracemalloc
+
+from scrapa.task import Task
+
+
+async def get_page(url):
+    pass
+
+
+def make_tuples(count):
+    return [(get_page, ('http://example.org/%d' % i,), {}, {'tried': 0}, 0)
+            for i in range(count)]
+
+
+def make_records(count):
+    return [Task(get_page, ('http://example.org/%d' % i,), {},
+                 task_id='%032x' % i)
+            for i in range(count)]
+
+
+def measure(factory, count):
+    tracemalloc.start()
+    tasks = factory(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tasks
+    return size
+
+
+def main(count=100000):
+    tuple_size = measure(make_tuples, count)
+    record_size = measure(make_records, count)
+    print('tuple entries: {:.1f} bytes per task'.format(tuple_size / count))
+    print('Task records:  {:.1f} bytes per task (including the task id)'.format(
+          record_size / count))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -1,5 +1,6 @@
 __version__ = '0.0.2'
 
 from .scraper import Scraper  # noqa
-from .exceptions import HttpError, HttpConnectionError  # noqa
-from .utils import async, store  # noqa
+from .exceptions import (DownloadSizeError, HttpError, HttpConnectionError,  # noqa
+                         TaskTimeoutError)
+from .utils import async, deadline, limit, store  # noqa
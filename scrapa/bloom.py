@@ -0,0 +1,46 @@
+import hashlib
+import math
+
+
+class BloomFilter():
+    """
+    Bloom filter for task ids. Sized for capacity keys at error_rate
+    false positives, but never larger than max_bytes (the false positive
+    rate goes up instead). Keys that were added are always reported as
+    present.
+    """
+    def __init__(self, capacity, error_rate=0.001, max_bytes=None):
+        capacity = max(capacity, 1)
+        size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if max_bytes:
+            size = min(size, max_bytes * 8)
+        self.size = max(size, 8)
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @property
+    def error_rate(self):
+        """Expected false positive rate at the current fill."""
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    def _indexes(self, key):
+        try:
+            # Task ids already are MD5 hex digests
+            value = int(key, 16)
+        except ValueError:
+            value = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+        # Double hashing with the two halves of the digest
+        h1 = value & 0xFFFFFFFFFFFFFFFF
+        h2 = (value >> 64) | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        for index in self._indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[index >> 3] & (1 << (index & 7))
+                   for index in self._indexes(key))
@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from aiohttp import hdrs
+
+
+def parse_cache_control(value):
+    """Return a dict of Cache-Control directives and their arguments."""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is not None and date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def is_storable(headers):
+    return 'no-store' not in parse_cache_control(headers.get(hdrs.CACHE_CONTROL))
+
+
+def get_header_ttl(headers):
+    """
+    Return the number of seconds the response may be reused according to
+    its Cache-Control or Expires header, or None if the headers don't say.
+    """
+    cache_control = parse_cache_control(headers.get(hdrs.CACHE_CONTROL))
+    if 'no-cache' in cache_control:
+        return 0
+    max_age = cache_control.get('max-age')
+    if max_age is not None:
+        try:
+            return max(int(max_age), 0)
+        except ValueError:
+            return 0
+    if hdrs.EXPIRES in headers:
+        expires = parse_http_date(headers[hdrs.EXPIRES])
+        if expires is None:
+            # Invalid dates like "0" mean already expired
+            return 0
+        date = parse_http_date(headers.get(hdrs.DATE)) or datetime.now(timezone.utc)
+        return max((expires - date).total_seconds(), 0)
+    return None
+
+
+def is_fresh(cache_entry):
+    expires = cache_entry['expires']
+    return expires is None or expires > datetime.now()
+
+
+def get_conditional_headers(cache_entry, headers=None):
+    """Add If-None-Match/If-Modified-Since for the cache entry to headers."""
+    headers = dict(headers or {})
+    if cache_entry['etag']:
+        headers[hdrs.IF_NONE_MATCH] = cache_entry['etag']
+    if cache_entry['last_modified']:
+        headers[hdrs.IF_MODIFIED_SINCE] = cache_entry['last_modified']
+    return headers
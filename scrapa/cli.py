@@ -28,6 +28,9 @@ class CommandLineMixin():
                             action='store_true',
                             default=False,
                             help='Clear the http cache')
+        scraper.add_argument('--workers', dest='workers', type=int,
+                            default=1,
+                            help='Number of worker processes to scrape with')
         scraper.add_argument('--loglevel', dest='loglevel',
                             default=ScrapaConfig.LOGLEVEL,
                             help='Loglevel: one of DEBUG, INFO, WARN, ERROR.')
@@ -83,6 +86,7 @@ class CommandLineMixin():
                 'task_name': task_dict['task_name'],
                 'args': task_dict['args'],
                 'kwargs': task_dict['kwargs'],
+                'priority': task_dict['priority'],
                 'meta': task_dict['kwargs']
             }, indent=None))
             outfile.write('\n')
@@ -109,7 +113,8 @@ class CommandLineMixin():
                     task['scraper_name'],
                     getattr(self, task['task_name']),
                     task['args'],
-                    task['kwargs']
+                    task['kwargs'],
+                    priority=task.get('priority', 0)
                 ))
             count += 1
             if not result:
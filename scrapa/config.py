@@ -1,8 +1,16 @@
 import asyncio
+from collections import Counter, OrderedDict
 import os
+import socket
+import uuid
 
 from .storage import DatabaseStorage
 from .logger import make_logger
+from .proxies import ProxyPool
+from .queue import DelayQueue, TaskQueue
+from .spill import SegmentSpill, get_spill_root
+from .throttle import AdaptiveLimiter, HostScheduler
+from .tracing import RequestTracer
 
 
 def get_default_storage(obj):
@@ -28,24 +36,82 @@ class ScrapaConfig:
     BASE_URL = ''
     PROGRESS_INTERVAL = 5
     CONNECTOR_LIMIT = 10
+    SHARE_CONNECTOR = True
+    KEEPALIVE_TIMEOUT = 30
+    DNS_CACHE_TTL = 300
     HTTP_CONCURENCY_LIMIT = 10
+    HOST_CONCURRENCY_LIMIT = 0
+    HOST_RATE_LIMIT = 0
+    HOST_RATE_BURST = 1
+    HOST_LIMITS = None
+    HOST_MAX_THROTTLES = 10000
+    HOST_IDLE_TIME = 300
+    ADAPTIVE_CONCURRENCY = False
+    ADAPTIVE_MIN_CONCURRENCY = 1
+    ADAPTIVE_MAX_CONCURRENCY = 100
+    ADAPTIVE_LATENCY_FACTOR = 2.0
     QUEUE_SIZE = 0
+    QUEUE_SPILL = False
+    QUEUE_SPILL_DIR = None
+    QUEUE_SPILL_SEGMENT_SIZE = 10000
     CONSUMER_COUNT = 10
+    STREAM_WINDOW = 100
+    SCHEDULE_BATCH_SIZE = 1000
+    PENDING_PAGE_SIZE = 1000
+    # Queue size below which the next page (or lease batch) is loaded, half
+    # a page by default
+    PENDING_LOW_WATER = None
     SESSION_POOL_SIZE = 10
     REUSE_SESSION = True
     REUSE_SESSION_COUNT = 1000
     CONNECT_TIMEOUT = 30
     MAX_RETRIES = 3
+    DOWNLOAD_MAX_SIZE = None
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    DOWNLOAD_READ_TIMEOUT = 60
+    INFLIGHT_REQUEST_LIMIT = 1000
+    CACHE_TTL = None
+    CACHE_KEY_HEADERS = ()
+    CACHE_USE_HEADERS = False
+    CACHE_MAX_SIZE = 0
+    CACHE_EVICTION_POLICY = 'lru'
+    CACHE_EVICTION_BATCH = 100
     CUSTOM_CA = None
     VERIFY_SSL = True
     ENABLE_WEBSERVER = True
+    TRACE_REQUESTS = True
+    TRACE_DUMP_PATH = None
+    CAPTURE_PAYLOADS = False
+    CAPTURE_PAYLOAD_LEVEL = 'DEBUG'
+    CAPTURE_PAYLOAD_HOSTS = ()
+    CAPTURE_PAYLOAD_SAMPLE_RATE = 1.0
+    CAPTURE_PAYLOAD_MAX_BYTES = 64 * 1024
     ENABLE_QUEUE = True
     MAX_TIMEOUT_COUNT = 3
     TASK_RETRY_COUNT = 3
+    TASK_TIMEOUT = None
+    WATCHDOG_THRESHOLD = 60
+    WATCHDOG_TASK_COUNT = 5
+    RETRY_BACKOFF_BASE = 1
+    RETRY_BACKOFF_MAX = 300
     STORAGE_ENABLED = True
+    DEDUP_FILTER = False
+    DEDUP_FILTER_CAPACITY = 1000000
+    DEDUP_FILTER_ERROR_RATE = 0.001
+    DEDUP_FILTER_MAX_BYTES = 64 * 1024 * 1024
+    DEDUP_RECENT_SIZE = 100000
+    TASK_LEASING = False
+    LEASE_DURATION = 300
+    LEASE_BATCH_SIZE = 100
     DEFAULT_USER_AGENT = 'Scrapa'
     LOGLEVEL = 'INFO'
     PROXY = None
+    PROXIES = ()
+    PROXY_MAX_FAILURES = 3
+    PROXY_MIN_SUCCESS_RATE = 0.5
+    PROXY_EJECT_TIME = 60
+    PROXY_PROBE_TIMEOUT = 60
+    PROXY_FAILURE_STATUSES = (407, 429)
     DEBUG_EXCEPTIONS = False
     ENCODING = 'utf-8'
     STORAGE = CallableDefaultValue(get_default_storage)
@@ -69,11 +135,63 @@ class ConfigurationMixin():
         self.stopping = False
         self.consumer_count = 0
         self.tasks_running = 0
+        self.running_tasks = {}
         self.timeout_count = 0
+        self.inflight_requests = {}
+        self.cache_stats = Counter()
+        self.eviction_future = None
         self.storage = None
+        self.task_filter = None
+        self.recent_task_ids = OrderedDict()
+        self.lease_owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                             uuid.uuid4().hex[:8])
         self.logger = make_logger(self.config.NAME, level=self.config.LOGLEVEL)
 
-        self.queue = asyncio.Queue(self.config.QUEUE_SIZE)
-        self.http_semaphore = asyncio.Semaphore(self.config.HTTP_CONCURENCY_LIMIT)
+        spill = None
+        if self.config.QUEUE_SPILL and self.config.QUEUE_SIZE:
+            spill = SegmentSpill(get_spill_root(self.config.QUEUE_SPILL_DIR),
+                                 self.config.NAME,
+                                 segment_size=self.config.QUEUE_SPILL_SEGMENT_SIZE)
+        self.queue = TaskQueue(self.config.QUEUE_SIZE, spill=spill,
+                               resolve=lambda name: getattr(self, name),
+                               get_host=self.get_task_host,
+                               host_ready=lambda host: self.host_scheduler.is_ready(host))
+        self.delay_queue = DelayQueue(self.queue)
+        self.pending_lock = asyncio.Lock()
+        self.pending_pass = None
+        self.refill_future = None
+        self.leases_exhausted = False
+        adaptive = None
+        if self.config.ADAPTIVE_CONCURRENCY:
+            adaptive = {
+                'min_limit': self.config.ADAPTIVE_MIN_CONCURRENCY,
+                'max_limit': self.config.ADAPTIVE_MAX_CONCURRENCY,
+                'latency_factor': self.config.ADAPTIVE_LATENCY_FACTOR
+            }
+            self.http_semaphore = AdaptiveLimiter(self.config.HTTP_CONCURENCY_LIMIT,
+                                                  **adaptive)
+        else:
+            self.http_semaphore = asyncio.Semaphore(self.config.HTTP_CONCURENCY_LIMIT)
+        self.host_scheduler = HostScheduler(
+            concurrency=self.config.HOST_CONCURRENCY_LIMIT,
+            rate=self.config.HOST_RATE_LIMIT,
+            burst=self.config.HOST_RATE_BURST,
+            host_limits=self.config.HOST_LIMITS,
+            adaptive=adaptive,
+            max_hosts=self.config.HOST_MAX_THROTTLES,
+            idle_time=self.config.HOST_IDLE_TIME
+        )
         self._session_pool = [None for _ in range(self.config.SESSION_POOL_SIZE)]
+        self.connectors = {}
+        self.proxy_pool = None
+        if self.config.PROXIES:
+            self.proxy_pool = ProxyPool(
+                self.config.PROXIES,
+                max_failures=self.config.PROXY_MAX_FAILURES,
+                min_success_rate=self.config.PROXY_MIN_SUCCESS_RATE,
+                eject_time=self.config.PROXY_EJECT_TIME,
+                probe_timeout=self.config.PROXY_PROBE_TIMEOUT
+            )
+        self.request_tracer = RequestTracer() if self.config.TRACE_REQUESTS else None
+        self.dns_cache_cleared = 0
         self._session_query_count = 0
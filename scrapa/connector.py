@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import aiohttp
+
+
+class StatsConnectorMixin():
+    """
+    Counts connection requests and newly opened connections and sets a
+    trace of the queue, dns and connect time on each request.
+    """
+    def __init__(self, *args, **kwargs):
+        super(StatsConnectorMixin, self).__init__(*args, **kwargs)
+        self.connection_requests = 0
+        self.connections_created = 0
+        # Traces of connections being made, by task
+        self.traces = {}
+
+    async def connect(self, req):
+        self.connection_requests += 1
+        task = asyncio.Task.current_task()
+        trace = {'queue': 0.0, 'dns': 0.0, 'connect': 0.0, 'reused': True}
+        self.traces[task] = trace
+        start = time.monotonic()
+        try:
+            return (await super(StatsConnectorMixin, self).connect(req))
+        finally:
+            del self.traces[task]
+            trace['queue'] = max(0.0, time.monotonic() - start - trace['dns'] - trace['connect'])
+            req.trace = trace
+
+    async def _create_connection(self, req):
+        self.connections_created += 1
+        trace = self.traces.get(asyncio.Task.current_task())
+        start = time.monotonic()
+        try:
+            return (await super(StatsConnectorMixin, self)._create_connection(req))
+        finally:
+            if trace is not None:
+                trace['reused'] = False
+                trace['connect'] = time.monotonic() - start - trace['dns']
+
+    async def _resolve_host(self, host, port):
+        start = time.monotonic()
+        try:
+            return (await super(StatsConnectorMixin, self)._resolve_host(host, port))
+        finally:
+            trace = self.traces.get(asyncio.Task.current_task())
+            if trace is not None:
+                trace['dns'] += time.monotonic() - start
+
+    def get_reuse_rate(self):
+        if not self.connection_requests:
+            return None
+        return 1 - self.connections_created / self.connection_requests
+
+
+class ScrapaTCPConnector(StatsConnectorMixin, aiohttp.TCPConnector):
+    pass
+
+
+class ScrapaProxyConnector(StatsConnectorMixin, aiohttp.connector.ProxyConnector):
+    pass
+
+
+class SharedConnectorSession(aiohttp.ClientSession):
+    """
+    Session on a connector that is shared with other sessions. Closing
+    the session drops its cookies but leaves the connector open.
+    """
+    def close(self):
+        self._connector = None
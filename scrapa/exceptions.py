@@ -7,3 +7,11 @@ class HttpError(HttpProcessingError):
 
 class HttpConnectionError(DisconnectedError, ClientError):
     pass
+
+
+class TaskTimeoutError(Exception):
+    pass
+
+
+class DownloadSizeError(Exception):
+    pass
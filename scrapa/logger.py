@@ -1,6 +1,7 @@
 import asyncio
 from datetime import datetime
 import logging
+import random
 import sys
 
 import aiohttp
@@ -9,7 +10,7 @@ from aiohttp import web
 from diagnostics.models import ExceptionInfo
 from diagnostics.logging import HtmlFormatter
 
-from .utils import json_dumps
+from .utils import Payload, json_dumps
 
 LEVEL_DICT = {
     'INFO': logging.INFO,
@@ -41,6 +42,31 @@ class LoggingMixin():
     def log_request(self, info):
         self.log_debug('request', info)
 
+    def has_payload_consumers(self):
+        """
+        Whether a handler at CAPTURE_PAYLOAD_LEVEL wants request payloads,
+        handlers opt in with a wants_payloads method.
+        """
+        level = LEVEL_DICT[self.config.CAPTURE_PAYLOAD_LEVEL]
+        for handler in self.logger.handlers:
+            wants_payloads = getattr(handler, 'wants_payloads', None)
+            if handler.level <= level and wants_payloads is not None and wants_payloads():
+                return True
+        return False
+
+    def capture_payload(self, host, content):
+        """Return the response body for the request log or None if not captured."""
+        config = self.config
+        if not config.CAPTURE_PAYLOADS or content is None:
+            return None
+        if config.CAPTURE_PAYLOAD_HOSTS and host not in config.CAPTURE_PAYLOAD_HOSTS:
+            return None
+        if random.random() >= config.CAPTURE_PAYLOAD_SAMPLE_RATE:
+            return None
+        if not self.has_payload_consumers():
+            return None
+        return Payload(content, max_bytes=config.CAPTURE_PAYLOAD_MAX_BYTES)
+
     def log_exception(self, info):
         self.logger.exception('exception', exc_info=True, extra={'scrapa': {
             'scraper': self.config.NAME,
@@ -62,6 +88,11 @@ def make_logger(name, level='DEBUG'):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
 
+    # Configuring again (e.g. in a forked worker) replaces the old handler
+    old_handler = getattr(logger, 'scrapa_console_handler', None)
+    if old_handler is not None:
+        logger.removeHandler(old_handler)
+
     console_handler = logging.StreamHandler()
     console_handler.setLevel(LEVEL_DICT[level])
     fmt = '%(name)s [%(levelname)-8s]: %(message)s'
@@ -69,6 +100,7 @@ def make_logger(name, level='DEBUG'):
     console_handler.setFormatter(formatter)
 
     logger.addHandler(console_handler)
+    logger.scrapa_console_handler = console_handler
     return logger
 
 
@@ -103,6 +135,9 @@ class WebsocketHandler(logging.Handler):
             exception_data['name'] = sys.exc_info()[0].__name__
             self.emit_to_subscribers(json_dumps(exception_data))
 
+    def wants_payloads(self):
+        return bool(self.dashboard_subscribers)
+
     def emit_to_subscribers(self, data):
         for sub in self.dashboard_subscribers:
             if not sub.closed:
@@ -0,0 +1,133 @@
+import time
+
+
+class Proxy():
+    def __init__(self, url, decay=0.1):
+        self.url = url
+        self.decay = decay
+        self.requests = 0
+        self.success_rate = 1.0
+        # Moving average of request latency in seconds
+        self.latency = 0.0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+        self.probing = False
+        self.probe_started = None
+
+    def __repr__(self):
+        return '<Proxy %s score=%.2f>' % (self.url, self.score)
+
+    @property
+    def score(self):
+        return self.success_rate / (1 + self.latency)
+
+    @property
+    def ejected(self):
+        return self.ejected_until is not None and not self.probing
+
+    def record(self, latency, error):
+        self.requests += 1
+        self.success_rate += self.decay * ((0.0 if error else 1.0) - self.success_rate)
+        if error:
+            self.failures += 1
+        else:
+            self.failures = 0
+            if self.requests == 1:
+                self.latency = latency
+            else:
+                self.latency += self.decay * (latency - self.latency)
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'requests': self.requests,
+            'success_rate': self.success_rate,
+            'latency': self.latency,
+            'score': self.score,
+            'ejected': self.ejected,
+            'probing': self.probing
+        }
+
+
+class ProxyPool():
+    """
+    Spreads sessions over proxies by score and load. Proxies that fail
+    max_failures times in a row or drop below min_success_rate are ejected
+    for eject_time seconds (doubling on every failed probe), after which a
+    single session probes them again. Probes without a request for
+    probe_timeout seconds are given up.
+    """
+    def __init__(self, urls, max_failures=3, min_success_rate=0.5, eject_time=60,
+                 max_eject_time=3600, min_requests=10, probe_timeout=None):
+        if not urls:
+            raise ValueError('Proxy pool needs at least one proxy')
+        self.proxies = [Proxy(url) for url in urls]
+        self.max_failures = max_failures
+        self.min_success_rate = min_success_rate
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.min_requests = min_requests
+        self.probe_timeout = eject_time if probe_timeout is None else probe_timeout
+
+    def choose(self, loads=None):
+        """Return the proxy with the best score per pinned session."""
+        loads = loads or {}
+        now = time.monotonic()
+        for proxy in self.proxies:
+            if proxy.probing and proxy.probe_started + self.probe_timeout <= now:
+                # The probing session went away before its first request
+                proxy.probing = False
+        candidates = [p for p in self.proxies if p.ejected_until is None]
+        probes = [p for p in self.proxies
+                  if p.ejected_until is not None and not p.probing and
+                  p.ejected_until <= now]
+        if probes:
+            return self.start_probe(min(probes, key=lambda p: p.ejected_until), now)
+        if not candidates:
+            # Everything is ejected, probe the proxy that comes back first
+            proxy = min(self.proxies, key=lambda p: p.ejected_until)
+            if not proxy.probing:
+                self.start_probe(proxy, now)
+            return proxy
+        return max(candidates,
+                   key=lambda p: p.score / (1 + loads.get(p, 0)))
+
+    def start_probe(self, proxy, now):
+        proxy.probing = True
+        proxy.probe_started = now
+        return proxy
+
+    def record(self, proxy, latency, error):
+        """
+        Record a request through proxy. Returns 'ejected' or 'reinstated'
+        if the state of the proxy changed.
+        """
+        proxy.record(latency, error)
+        if proxy.probing:
+            proxy.probing = False
+            if error:
+                self.eject(proxy)
+                return 'ejected'
+            proxy.ejected_until = None
+            proxy.ejections = 0
+            proxy.success_rate = max(proxy.success_rate, self.min_success_rate)
+            return 'reinstated'
+        if proxy.ejected_until is not None:
+            return None
+        if proxy.failures >= self.max_failures or (
+                proxy.requests >= self.min_requests and
+                proxy.success_rate < self.min_success_rate):
+            self.eject(proxy)
+            return 'ejected'
+        return None
+
+    def eject(self, proxy):
+        proxy.ejections += 1
+        proxy.failures = 0
+        eject_time = min(self.eject_time * 2 ** (proxy.ejections - 1),
+                         self.max_eject_time)
+        proxy.ejected_until = time.monotonic() + eject_time
+
+    def get_stats(self):
+        return [proxy.to_dict() for proxy in self.proxies]
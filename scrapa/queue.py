@@ -1,4 +1,9 @@
 import asyncio
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import time
 import traceback
 import sys
 try:
@@ -6,7 +11,460 @@ try:
 except ImportError:
     import pdb
 
-from .utils import args_kwargs_iterator, add_func_to_iterator
+from .exceptions import TaskTimeoutError
+from .task import Task
+from .throttle import get_backoff
+from .utils import (args_kwargs_iterator, add_func_to_iterator, json_dumps,
+                    json_loads)
+
+
+# Put on the queue once per consumer to shut it down
+STOP_CONSUMER = None
+
+NO_PRIORITY = float('-inf')
+
+
+class TaskLane():
+    """
+    Queued entries and dispatch state of one task function. Entries are
+    kept in a heap per host and heads holds the top entry of every host,
+    so the best task of a host that isn't throttled is found without
+    looking at the other tasks of throttled hosts.
+    """
+    def __init__(self, concurrency=0, weight=1):
+        self.hosts = {}
+        self.heads = []
+        self.size = 0
+        self.running = 0
+        self.concurrency = concurrency
+        self.weight = weight
+        self.pass_value = 0.0
+
+    def can_run(self):
+        if not self.size:
+            return False
+        return not self.concurrency or self.running < self.concurrency
+
+    def push(self, entry, host):
+        entries = self.hosts.setdefault(host, [])
+        heapq.heappush(entries, entry)
+        if entries[0] is entry:
+            heapq.heappush(self.heads, (entry[:2], host))
+        self.size += 1
+
+    def peek(self, host_ready):
+        """
+        Return the sort key and host of the best entry of a host that is
+        ready and whether hosts were skipped because they are throttled.
+        Outdated heads are dropped on the way.
+        """
+        skipped = []
+        try:
+            while self.heads:
+                key, host = self.heads[0]
+                entries = self.hosts.get(host)
+                if not entries or entries[0][:2] != key:
+                    heapq.heappop(self.heads)
+                elif host_ready(host):
+                    return key, host, bool(skipped)
+                else:
+                    skipped.append(heapq.heappop(self.heads))
+            return None, None, bool(skipped)
+        finally:
+            for head in skipped:
+                heapq.heappush(self.heads, head)
+
+    def pop(self, host):
+        entries = self.hosts[host]
+        task = heapq.heappop(entries)[-1]
+        if entries:
+            heapq.heappush(self.heads, (entries[0][:2], host))
+        else:
+            del self.hosts[host]
+        self.size -= 1
+        if not self.size:
+            self.heads = []
+        return task
+
+    def remove(self, task):
+        for host, entries in self.hosts.items():
+            for i, entry in enumerate(entries):
+                if entry[-1] is task:
+                    top = entries[0]
+                    entries.pop(i)
+                    heapq.heapify(entries)
+                    if not entries:
+                        del self.hosts[host]
+                    elif entries[0] is not top:
+                        heapq.heappush(self.heads, (entries[0][:2], host))
+                    self.size -= 1
+                    return
+
+    def get_lowest_entry(self):
+        return max((max(entries) for entries in self.hosts.values()), default=None)
+
+    def clear(self):
+        self.hosts = {}
+        self.heads = []
+        self.size = 0
+
+
+class TaskQueue():
+    """
+    Queue of Task records with a lane per task function. Higher
+    priorities come out first. Lanes with the same top priority are
+    served in proportion to the weight of their task function (stride
+    scheduling) and a lane that reached the concurrency limit of its
+    function is skipped until one of its tasks is done.
+    Call task_done(task) for every task that was taken off the queue.
+
+    With a SegmentSpill as spill, puts never block: tasks beyond maxsize
+    go to disk in the order they were put and are read back when the
+    memory part is half empty or none of its lanes can run. A task with a
+    higher priority than everything on disk stays in memory and pushes
+    the lowest priority task out instead. resolve maps a task name back
+    to its coroutine function. Tasks of other functions and tasks with
+    arguments that can't be serialized stay in memory.
+
+    get_host maps a task to the host it will request (or None) and
+    host_ready tells if that host can take a request right now. Tasks of
+    throttled hosts are skipped for other tasks and consumers check again
+    after host_poll_interval seconds if only throttled hosts are left.
+    """
+    def __init__(self, maxsize=0, spill=None, resolve=None, get_host=None,
+                 host_ready=None, host_poll_interval=0.1):
+        self.maxsize = maxsize
+        self.spill = spill
+        self.resolve = resolve
+        self.get_host = get_host
+        self.host_ready = host_ready
+        self.host_poll_interval = host_poll_interval
+        self._poll_handle = None
+        self.lanes = {}
+        self._size = 0
+        self._stops = 0
+        # Highest priority on disk
+        self._spill_priority = NO_PRIORITY
+        self._virtual_time = 0.0
+        self._counter = itertools.count()
+        self._getters = deque()
+        self._putters = deque()
+
+    def qsize(self):
+        if self.spill is not None:
+            return self._size + len(self.spill)
+        return self._size
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self.spill is None and self.memory_full()
+
+    def memory_full(self):
+        return 0 < self.maxsize <= self._size
+
+    def get_lane(self, coro):
+        name = coro.__name__
+        if name not in self.lanes:
+            self.lanes[name] = TaskLane(
+                concurrency=getattr(coro, 'task_concurrency', 0),
+                weight=getattr(coro, 'task_weight', 1)
+            )
+        return self.lanes[name]
+
+    def put_nowait(self, task):
+        if task is STOP_CONSUMER:
+            self._stops += 1
+            self._wake_up(self._getters)
+            return
+        if self.full():
+            raise asyncio.QueueFull
+        if self.spill is not None and (self.memory_full() or len(self.spill)):
+            if task.priority > self._spill_priority and self.memory_full():
+                # Keep it in memory and spill the lowest priority task instead
+                lowest = self.get_lowest_task()
+                if (lowest is not None and lowest.priority < task.priority and
+                        self.spill_task(lowest)):
+                    self._remove(lowest)
+                    self._push(task)
+                    self._wake_up(self._getters)
+                    return
+            if ((task.priority <= self._spill_priority or self.memory_full()) and
+                    self.spill_task(task)):
+                self._wake_up(self._getters)
+                return
+        self._push(task)
+        self._wake_up(self._getters)
+
+    def spill_task(self, task):
+        if not self.can_resolve(task):
+            return False
+        try:
+            line = json_dumps({
+                'task_name': task.name,
+                'args': task.args,
+                'kwargs': task.kwargs,
+                'task_id': task.task_id,
+                'tried': task.tried,
+                'priority': task.priority
+            }, indent=None)
+        except TypeError:
+            return False
+        self.spill.append(line)
+        self._spill_priority = max(self._spill_priority, task.priority)
+        return True
+
+    def can_resolve(self, task):
+        """Only tasks that resolve maps back to their function can be spilled."""
+        try:
+            return self.resolve(task.name) == task.coro
+        except AttributeError:
+            return False
+
+    def unspill(self, count=None):
+        if count is None:
+            count = self.maxsize - self._size
+        for line in self.spill.pop_many(count):
+            data = json_loads(line)
+            self._push(Task(self.resolve(data['task_name']), data['args'],
+                            data['kwargs'], task_id=data['task_id'],
+                            tried=data['tried'], priority=data['priority']))
+        if not len(self.spill):
+            self._spill_priority = NO_PRIORITY
+
+    def get_lowest_task(self):
+        """Return the queued task with the lowest priority, the newest on ties."""
+        lowest = None
+        for lane in self.lanes.values():
+            entry = lane.get_lowest_entry()
+            if entry is not None and (lowest is None or entry[:2] > lowest[:2]):
+                lowest = entry
+        return lowest[-1] if lowest is not None else None
+
+    def _remove(self, task):
+        self.get_lane(task.coro).remove(task)
+        self._size -= 1
+
+    def _push(self, task):
+        lane = self.get_lane(task.coro)
+        if not lane.size:
+            # Idle lanes don't save up credit while they are empty
+            lane.pass_value = max(lane.pass_value, self._virtual_time)
+        host = self.get_host(task) if self.get_host is not None else None
+        lane.push((-task.priority, next(self._counter), task), host)
+        self._size += 1
+
+    async def put(self, task):
+        while task is not STOP_CONSUMER and self.full():
+            await self._wait(self._putters)
+        self.put_nowait(task)
+
+    def get_nowait(self):
+        if self._stops:
+            self._stops -= 1
+            return STOP_CONSUMER
+        if self.spill is not None and len(self.spill) and self._size <= self.maxsize // 2:
+            self.unspill()
+        best_lane, host, throttled = self._get_next_lane()
+        if (best_lane is None and self.spill is not None and len(self.spill) and
+                self._size < 2 * self.maxsize):
+            # Everything in memory waits for a lane at its concurrency
+            # limit or a throttled host, load more tasks for the others
+            self.unspill(max(self.maxsize // 2, 1))
+            best_lane, host, throttled = self._get_next_lane()
+        if best_lane is None:
+            if throttled:
+                self._schedule_poll()
+            raise asyncio.QueueEmpty
+        self._virtual_time = best_lane.pass_value
+        best_lane.pass_value += 1 / best_lane.weight
+        best_lane.running += 1
+        self._size -= 1
+        self._wake_up(self._putters)
+        return best_lane.pop(host)
+
+    def _get_next_lane(self):
+        """
+        Return the lane and host to take the next task from and whether
+        tasks were passed over because their host is throttled.
+        """
+        best_lane = None
+        best_host = None
+        best_key = None
+        throttled = False
+        ready = {None: True}
+
+        def host_ready(host):
+            if host not in ready:
+                ready[host] = self.host_ready is None or self.host_ready(host)
+            return ready[host]
+
+        for lane in self.lanes.values():
+            if not lane.can_run():
+                continue
+            entry_key, host, skipped = lane.peek(host_ready)
+            throttled = throttled or skipped
+            if entry_key is None:
+                continue
+            key = (entry_key[0], lane.pass_value, entry_key[1])
+            if best_key is None or key < best_key:
+                best_lane, best_host, best_key = lane, host, key
+        return best_lane, best_host, throttled
+
+    def _schedule_poll(self):
+        if self._poll_handle is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self._poll_handle = loop.call_later(self.host_poll_interval, self._poll)
+
+    def _poll(self):
+        self._poll_handle = None
+        while self._getters:
+            self._wake_up(self._getters)
+
+    async def get(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                await self._wait(self._getters)
+
+    def task_done(self, task):
+        if task is STOP_CONSUMER:
+            return
+        lane = self.get_lane(task.coro)
+        lane.running -= 1
+        if lane.can_run():
+            self._wake_up(self._getters)
+
+    def clear(self):
+        """Drop all queued entries, running tasks still count."""
+        for lane in self.lanes.values():
+            lane.clear()
+        self._size = 0
+        self._stops = 0
+        self._spill_priority = NO_PRIORITY
+        if self.spill is not None:
+            self.spill.clear()
+        while self._putters:
+            self._wake_up(self._putters)
+
+    async def _wait(self, waiters):
+        waiter = asyncio.Future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Pass on the wake up we got just before the cancellation
+                self._wake_up(waiters)
+            raise
+
+    def _wake_up(self, waiters):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+class DelayQueue():
+    """
+    Holds tasks until they are due and then puts them on the target
+    queue. A single timer handle is used for all tasks, waiting tasks
+    don't occupy a consumer.
+    """
+    def __init__(self, target):
+        self.target = target
+        self._heap = []
+        self._counter = itertools.count()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, task, delay):
+        loop = asyncio.get_event_loop()
+        heapq.heappush(self._heap, (loop.time() + delay, next(self._counter), task))
+        self._schedule()
+
+    def clear(self):
+        self._heap = []
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._heap:
+            loop = asyncio.get_event_loop()
+            self._timer = loop.call_at(self._heap[0][0], self._release)
+
+    def _release(self):
+        self._timer = None
+        loop = asyncio.get_event_loop()
+        while self._heap and self._heap[0][0] <= loop.time():
+            if self.target.full():
+                # Try again later instead of blocking the event loop
+                due, count, task = heapq.heappop(self._heap)
+                heapq.heappush(self._heap, (loop.time() + 0.5, count, task))
+                break
+            _, _, task = heapq.heappop(self._heap)
+            self.target.put_nowait(task)
+        self._schedule()
+
+
+TaskResult = namedtuple('TaskResult', ['coro', 'args', 'kwargs', 'result', 'exception'])
+
+
+class TaskStream():
+    """
+    Async iterator that runs tasks from a (coro, (args, kwargs)) iterator
+    with at most window tasks in flight and yields a TaskResult for each
+    one in the order they complete. The iterator is only advanced when a
+    slot in the window is free.
+    """
+    def __init__(self, scraper, iterator, window):
+        self.scraper = scraper
+        self.iterator = iterator
+        self.window = window
+        self.pending = {}
+        self.finished = deque()
+
+    def fill(self):
+        while len(self.pending) < self.window:
+            try:
+                coro, (args, kwargs) = next(self.iterator)
+            except StopIteration:
+                break
+            future = asyncio.ensure_future(
+                self.scraper.run_one(coro, *args, **kwargs))
+            self.pending[future] = (coro, args, kwargs)
+
+    def cancel(self):
+        for future in self.pending:
+            future.cancel()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.fill()
+        if not self.finished:
+            if not self.pending:
+                raise StopAsyncIteration
+            done, _ = await asyncio.wait(self.pending,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                self.finished.append((future, self.pending.pop(future)))
+        future, (coro, args, kwargs) = self.finished.popleft()
+        if future.cancelled():
+            return TaskResult(coro, args, kwargs, None, asyncio.CancelledError())
+        exception = future.exception()
+        if exception is not None:
+            return TaskResult(coro, args, kwargs, None, exception)
+        return TaskResult(coro, args, kwargs, future.result(), None)
 
 
 class QueueMixin():
@@ -17,33 +475,74 @@ class QueueMixin():
 
     def queue_finished(self):
         qsize = self.queue.qsize()
-        return qsize == 0 and self.tasks_running == 0
+        return qsize == 0 and self.tasks_running == 0 and len(self.delay_queue) == 0
 
     async def consume_queue(self):
-        """ Use get_nowait construct until Py 3.4.4 """
         try:
             self.consumer_count += 1
             while True:
+                task = await self.queue.get()
                 try:
-                    if self.terminate_consumers:
+                    if task is STOP_CONSUMER:
                         return
-                    coro, args, kwargs, meta = self.queue.get_nowait()
+                    if self.queue.qsize() < self.get_refill_threshold():
+                        self.refill_queue()
                     self.tasks_running += 1
                     try:
-                        await self.run_task(coro, *args, **kwargs)
+                        await self.execute_task(task)
                     except Exception:
-                        if self.storage_enabled(coro):
-                            if meta is not None and meta.get('tried') < self.config.TASK_RETRY_COUNT:
-                                await self.add_to_queue(coro, args, kwargs, meta)
+                        await self.retry_task(task)
                     finally:
                         self.tasks_running -= 1
-                        if hasattr(self.queue, 'task_done'):
-                            self.queue.task_done()
-                except asyncio.QueueEmpty:
-                    await asyncio.sleep(0.5)
+                finally:
+                    self.queue.task_done(task)
         finally:
             self.consumer_count -= 1
 
+    def get_task_host(self, task):
+        """
+        Host a queued task will most likely request: the host of its url
+        keyword argument or of a first positional argument that is a string.
+        """
+        url = task.kwargs.get('url')
+        if url is None and task.args:
+            url = task.args[0]
+        if not isinstance(url, str):
+            return None
+        return self.host_scheduler.get_host(self.get_full_url(url)) or None
+
+    def get_retry_delay(self, attempt):
+        return get_backoff(attempt, self.config.RETRY_BACKOFF_BASE,
+                           self.config.RETRY_BACKOFF_MAX)
+
+    async def retry_task(self, task):
+        """
+        Put a failed stored task on the delay queue with exponential
+        backoff and remember the time of the next attempt in storage.
+        """
+        if not self.storage_enabled(task.coro):
+            return
+        task.tried += 1
+        if task.tried >= self.config.TASK_RETRY_COUNT:
+            return
+        delay = self.get_retry_delay(task.tried)
+        await self.store_task_retry(task, datetime.now() + timedelta(seconds=delay))
+        # Leased tasks go back to the pool and are leased again after the delay
+        if not self.config.TASK_LEASING:
+            self.delay_queue.put(task, delay)
+
+    async def stop_consumers(self):
+        """
+        Drop everything that is still queued and wake up every consumer
+        with a stop sentinel.
+        """
+        self.delay_queue.clear()
+        self.queue.clear()
+        if not self.config.ENABLE_QUEUE:
+            return
+        for _ in range(self.config.CONSUMER_COUNT):
+            await self.queue.put(STOP_CONSUMER)
+
     async def run_many(self, coro_arg, generator):
         generator = args_kwargs_iterator(generator)
         generator = add_func_to_iterator(coro_arg, generator)
@@ -53,6 +552,19 @@ class QueueMixin():
         assert len(pending) == 0
         return (d.result() for d in done)
 
+    def stream_many(self, coro_arg, generator, window=None):
+        """
+        Like run_many, but returns a TaskStream to iterate over with
+        async for. At most window tasks (STREAM_WINDOW by default) run at
+        the same time and failures are reported on the TaskResult instead
+        of being raised.
+        """
+        if window is None:
+            window = self.config.STREAM_WINDOW
+        generator = args_kwargs_iterator(generator)
+        generator = add_func_to_iterator(coro_arg, generator)
+        return TaskStream(self, generator, window)
+
     async def run_one(self, coro, *args, **kwargs):
         if not asyncio.iscoroutinefunction(coro):
             raise Exception('Given task %s is not a coroutine! Decorate it with @scrapa.async', coro)
@@ -60,6 +572,15 @@ class QueueMixin():
         return result
 
     async def run_task(self, coro, *args, **kwargs):
+        result = await self.execute_task(Task(coro, args, kwargs))
+        return result
+
+    async def execute_task(self, task, deadline=True):
+        """
+        Run a task and store its result. Without deadline (used for start)
+        TASK_TIMEOUT doesn't apply and the watchdog ignores the task.
+        """
+        coro, args, kwargs = task.coro, task.args, task.kwargs
         failed = False
         done = False
         value = None
@@ -67,12 +588,16 @@ class QueueMixin():
         try:
             self.stats['counter']['tasks_tried'] += 1
             self.tasks_running += 1
+            if deadline:
+                self.running_tasks[task] = time.monotonic()
             self.log_task_start({
                 'task_name': coro.__name__,
                 'args': args,
                 'kwargs': kwargs,
             })
-            result = (await coro(*args, **kwargs))
+            result = (await self.run_with_deadline(
+                coro, args, kwargs,
+                default=self.config.TASK_TIMEOUT if deadline else None))
             self.log_task_end({
                 'task_name': coro.__name__,
                 'args': args,
@@ -84,6 +609,8 @@ class QueueMixin():
                               coro.__name__, args, kwargs)
             # self.logger.exception(e)
             self.stats['counter']['tasks_failed'] += 1
+            if isinstance(e, TaskTimeoutError):
+                self.stats['counter']['tasks_timed_out'] += 1
             self.log_exception(e)
 
             if self.config.DEBUG_EXCEPTIONS:
@@ -100,52 +627,211 @@ class QueueMixin():
             return result
         finally:
             self.tasks_running -= 1
+            self.running_tasks.pop(task, None)
             if self.storage_enabled(coro):
                 await self.store_task_result(
                     self.config.NAME,
                     coro, args, kwargs,
                     done, failed,
-                    str(value), exception
+                    str(value), exception,
+                    task_id=task.task_id
                 )
 
-    async def schedule_many(self, coro_arg, generator):
+    async def run_with_deadline(self, coro, args, kwargs, default=None):
+        """
+        Await the task, cancelling it after the deadline of its function
+        (see @scrapa.deadline) or default seconds.
+        """
+        seconds = getattr(coro, 'task_timeout', default)
+        if not seconds:
+            return (await coro(*args, **kwargs))
+        task = asyncio.ensure_future(coro(*args, **kwargs))
+        expired = []
+
+        def expire():
+            # TimeoutErrors raised by the task itself are not deadlines
+            expired.append(True)
+            task.cancel()
+
+        handle = asyncio.get_event_loop().call_later(seconds, expire)
+        try:
+            return (await task)
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+            raise TaskTimeoutError('{} timed out after {} seconds'.format(
+                coro.__name__, seconds))
+        finally:
+            handle.cancel()
+
+    def log_stuck_tasks(self):
+        """Log the longest running tasks that exceed WATCHDOG_THRESHOLD."""
+        now = time.monotonic()
+        stuck = heapq.nlargest(
+            self.config.WATCHDOG_TASK_COUNT,
+            ((task, started) for task, started in self.running_tasks.items()
+             if now - started >= self.config.WATCHDOG_THRESHOLD),
+            key=lambda item: now - item[1]
+        )
+        for task, started in stuck:
+            self.logger.warning('Task %s(*%s, **%s) running for %d seconds',
+                                task.name, task.args, task.kwargs, now - started)
+
+    async def schedule_many(self, coro_arg, generator, task_priority=0):
         count = 0
         schedule_count = 0
         generator = args_kwargs_iterator(generator)
         generator = add_func_to_iterator(coro_arg, generator)
-        for coro, (args, kwargs) in generator:
-            scheduled = await self.schedule_one(coro, *args, **kwargs)
-            count += 1
-            if scheduled:
-                schedule_count += 1
+        while True:
+            batch = list(itertools.islice(generator, self.config.SCHEDULE_BATCH_SIZE))
+            if not batch:
+                break
+            schedule_count += await self.schedule_batch(batch, task_priority=task_priority)
+            count += len(batch)
         self.logger.info('Scheduled %s tasks (%s already present)',
                          schedule_count, count - schedule_count)
 
-    async def schedule_one(self, coro, *args, **kwargs):
+    async def schedule_batch(self, batch, task_priority=0):
+        """
+        Schedule a list of (coro, (args, kwargs)) items with one storage
+        call for all stored tasks. Returns the number of queued tasks.
+        """
+        tasks = []
+        for coro, (args, kwargs) in batch:
+            if not asyncio.iscoroutinefunction(coro):
+                raise Exception('Given task %s is not a coroutine! Decorate it with @scrapa.async', coro)
+            tasks.append(await self.make_task(coro, args, kwargs, task_priority))
+        to_store = [task for task in tasks if task.task_id is not None]
+        new_task_ids = set()
+        if to_store:
+            new_task_ids = await self.store_tasks(to_store)
+        schedule_count = 0
+        for task in tasks:
+            if task.task_id is not None:
+                if task.task_id not in new_task_ids:
+                    continue
+                # Only queue the first of duplicates within the batch
+                new_task_ids.remove(task.task_id)
+                if not self.owns_task(task.task_id):
+                    continue
+            await self.add_to_queue(task)
+            schedule_count += 1
+        return schedule_count
+
+    async def schedule_one(self, coro, *args, task_priority=0, **kwargs):
+        """
+        Schedule coro(*args, **kwargs) to run on the queue. Tasks with a
+        higher task_priority run first.
+        """
         if not asyncio.iscoroutinefunction(coro):
             raise Exception('Given task %s is not a coroutine! Decorate it with @scrapa.async', coro)
-        should_run = await self.prepare_schedule(coro, args, kwargs)
+        task = await self.make_task(coro, args, kwargs, task_priority)
+        should_run = await self.prepare_schedule(task)
+        if should_run and task.task_id is not None:
+            should_run = self.owns_task(task.task_id)
         if should_run:
-            await self.add_to_queue(coro, args, kwargs)
+            await self.add_to_queue(task)
             return True
         return False
 
-    async def add_to_queue(self, coro, args, kwargs, meta=None):
-        await self.queue.put((coro, args, kwargs, meta))
+    async def make_task(self, coro, args, kwargs, priority=0):
+        """Create the Task record, stored tasks get their id right away."""
+        task = Task(coro, args, kwargs, priority=priority)
+        if self.storage_enabled(coro):
+            storage = await self.get_storage()
+            task.task_id = storage.get_task_id(coro, args, kwargs)
+        return task
+
+    async def add_to_queue(self, task):
+        await self.queue.put(task)
 
     async def queue_pending_tasks(self):
-        storage = await self.get_storage()
-        tasks = await storage.get_pending_tasks(self.config.NAME)
+        """
+        Queue the next page of pending tasks from storage. Pages are read
+        with a cursor in passes over all tasks that were pending when the
+        pass started. A new pass is only started once the last one is
+        exhausted, so call this when the queue is finished.
+        Returns the number of queued tasks.
+        """
+        if self.worker_index is None:
+            # Seeding parent process, the workers load their own tasks
+            return 0
+        async with self.pending_lock:
+            if self.config.TASK_LEASING:
+                tasks = await self.lease_tasks()
+                # Don't ask again until the next progress tick
+                self.leases_exhausted = len(tasks) < self.config.LEASE_BATCH_SIZE
+                return await self.queue_task_dicts(tasks)
+            storage = await self.get_storage()
+            if self.pending_pass is None:
+                # Tasks scheduled later are queued when they are stored
+                self.pending_pass = {'cursor': None, 'until': datetime.now()}
+            queued = 0
+            while queued == 0 and self.pending_pass is not None:
+                tasks = list(await storage.get_pending_tasks(
+                    self.config.NAME,
+                    after=self.pending_pass['cursor'],
+                    limit=self.config.PENDING_PAGE_SIZE,
+                    until=self.pending_pass['until'],
+                    shard=self.get_task_shard()
+                ))
+                if len(tasks) < self.config.PENDING_PAGE_SIZE:
+                    self.pending_pass = None
+                else:
+                    self.pending_pass['cursor'] = tasks[-1]['cursor']
+                queued += await self.queue_task_dicts(tasks)
+            return queued
+
+    def get_refill_threshold(self):
+        if self.config.PENDING_LOW_WATER is not None:
+            return self.config.PENDING_LOW_WATER
+        if self.config.TASK_LEASING:
+            return self.config.LEASE_BATCH_SIZE // 2
+        return self.config.PENDING_PAGE_SIZE // 2
+
+    def refill_queue(self):
+        """
+        Continue the current pass over pending tasks in the background.
+        Consumers call this when the queue runs low. Queue puts block when
+        the queue is full.
+        """
+        if self.refill_future is not None and not self.refill_future.done():
+            return
+        if self.config.TASK_LEASING:
+            if self.leases_exhausted:
+                return
+        elif self.pending_pass is None:
+            return
+        self.refill_future = asyncio.ensure_future(self.queue_pending_tasks())
+
+    async def wait_for_refill(self):
+        if self.refill_future is not None:
+            await self.refill_future
+
+    async def queue_task_dicts(self, tasks):
+        queued = 0
+        now = datetime.now()
         for task_dict in tasks:
-            await self.add_to_queue(
+            if not self.owns_task(task_dict['task_id']):
+                continue
+            task = Task(
                 getattr(self, task_dict['task_name']),
                 task_dict['args'],
                 task_dict['kwargs'],
-                meta=task_dict['meta']
+                task_id=task_dict['task_id'],
+                tried=task_dict['meta'].get('tried') or 0,
+                priority=task_dict['priority']
             )
+            next_attempt = task_dict.get('next_attempt')
+            if next_attempt is not None and next_attempt > now:
+                self.delay_queue.put(task, (next_attempt - now).total_seconds())
+            else:
+                await self.queue.put(task)
+            queued += 1
+        return queued
 
-    async def prepare_schedule(self, coro, args, kwargs):
+    async def prepare_schedule(self, task):
         should_run = True
-        if self.storage_enabled(coro):
-            should_run = await self.store_task(coro, args, kwargs)
+        if task.task_id is not None:
+            should_run = await self.store_task(task)
         return should_run
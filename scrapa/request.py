@@ -1,18 +1,66 @@
 import asyncio
-import base64
+from collections import Counter
 from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+import os
+import re
 from urllib.parse import urljoin, urlsplit, urlencode, parse_qsl, urlunsplit
+import time
 import uuid
 import ssl
 
 import aiohttp
+from aiohttp import hdrs
 from aiohttp.client import ClientRequest
 
-from .exceptions import HttpConnectionError, HttpError
+from .cache import get_conditional_headers, is_fresh
+from .connector import ScrapaProxyConnector, ScrapaTCPConnector, SharedConnectorSession
+from .exceptions import DownloadSizeError, HttpConnectionError, HttpError
 from .session import SessionWrapper
+from .throttle import AdaptiveLimiter, RequestSlots, parse_retry_after
+from .tracing import get_body_size, make_request_trace
 from .response import ScrapaClientResponse, CachedResponse
-from .utils import get_cache_id
+from .utils import get_request_fingerprint
+
+
+def is_overload_status(status):
+    return status == 429 or status >= 500
+
+
+# Methods that get a 304 for a matching conditional request
+CONDITIONAL_METHODS = ('GET', 'HEAD')
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)')
+
+
+def parse_content_range(value):
+    """Return (start, total) of a Content-Range header, None for unknown parts."""
+    match = CONTENT_RANGE_RE.match(value or '')
+    if match is None:
+        return None, None
+    start, total = match.groups()
+    return (int(start) if start is not None else None,
+            int(total) if total != '*' else None)
+
+
+def get_range_validator(headers):
+    """Return a strong ETag or else the Last-Modified date for If-Range."""
+    etag = headers.get(hdrs.ETAG)
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get(hdrs.LAST_MODIFIED)
+
+
+def rewind_sink(sink, transfer):
+    """Empty sink to start transfer over, returns False if it can't seek."""
+    if not getattr(sink, 'seekable', lambda: False)():
+        return False
+    sink.seek(0)
+    sink.truncate()
+    transfer['size'] = 0
+    transfer['digest'] = hashlib.new(transfer['digest'].name)
+    return True
 
 
 class ScrapaClientRequest(ClientRequest):
@@ -44,26 +92,53 @@ class ScrapaClientRequest(ClientRequest):
 
 class RequestMixin():
     async def request(self, method, url='', **kwargs):
+        """
+        Make a request. With cache=True responses are cached by their
+        request fingerprint (see get_request_fingerprint), cache_ttl sets
+        the lifetime of the cache entry in seconds.
+        """
+        cache = kwargs.pop('cache', False)
+        cache_ttl = kwargs.pop('cache_ttl', None)
+        if cache:
+            cache_id = self.get_request_fingerprint(method, url, kwargs)
+            if cache_id is not None:
+                return (await self.cached_request(cache_id, method, url,
+                                                  cache_ttl=cache_ttl, **kwargs))
+        return (await self.send_request(method, url, **kwargs))
+
+    async def send_request(self, method, url='', **kwargs):
         session_arg = kwargs.pop('session', None)
         status_only = kwargs.pop('status_only', False)
+        stream = kwargs.pop('stream', False)
         raise_for_status = kwargs.pop('raise_for_status', True)
         response = None
         error_msg = None
         req_uuid = str(uuid.uuid4())
+        url = self.get_full_url(url)
+        # Wait for the host before taking a global slot so that a throttled
+        # host doesn't block requests to other hosts
+        host_throttle = self.host_scheduler.get_throttle(url)
         for retry_num in range(self.config.MAX_RETRIES):
-            with (await self.http_semaphore):
+            slots = RequestSlots(host_throttle, self.http_semaphore)
+            async with slots:
                 with self.use_request_session(session_arg) as session:
-                    url = self.get_full_url(url)
-                    b64_data = None
+                    payload = None
+                    trace = None
                     try:
                         start_time = datetime.utcnow()
+                        started = time.monotonic()
                         response = await asyncio.wait_for(
                             session.request(method, url, **kwargs),
                             self.config.CONNECT_TIMEOUT)
+                        headers_received = time.monotonic()
                         response.scrapa = self
-                        if not status_only:
-                            b64_data = await response.read()
-                            b64_data = base64.b64encode(b64_data).decode('utf-8'),
+                        content = body_read = None
+                        if not status_only and not stream:
+                            content = await response.read()
+                            body_read = time.monotonic()
+                            payload = self.capture_payload(host_throttle.host, content)
+                        trace = self.trace_request(host_throttle.host, response, started,
+                                                   headers_received, body_read, content)
                     except asyncio.TimeoutError as e:
                         error_msg = 'Request timed out'
                         self.timeout_count += 1
@@ -74,10 +149,32 @@ class RequestMixin():
                     except aiohttp.ServerDisconnectedError as e:
                         error_msg = 'Server disconnected error: {}'.format(e)
                     else:
-                        error_msg = None
                         self.timeout_count = 0
-                        break
+                        self.update_host_throttle(host_throttle, response)
+                        if (response.status == 429 and
+                                retry_num + 1 < self.config.MAX_RETRIES):
+                            error_msg = 'Too many requests to {}'.format(host_throttle.host)
+                        else:
+                            error_msg = None
+                            if stream:
+                                # Keep the slots until the caller released the body
+                                slots.detach()
+                                response.on_release = slots.release
+                            break
                     finally:
+                        latency = (datetime.utcnow() - start_time).total_seconds()
+                        self.record_request_outcome(
+                            host_throttle, latency,
+                            error_msg is not None or (
+                                response is not None and is_overload_status(response.status))
+                        )
+                        if self.proxy_pool is not None:
+                            self.record_proxy_outcome(
+                                session, latency,
+                                error_msg is not None or (
+                                    response is not None and
+                                    response.status in self.config.PROXY_FAILURE_STATUSES)
+                            )
                         self.log_request({
                             'req_uuid': req_uuid,
                             'method': method,
@@ -88,11 +185,13 @@ class RequestMixin():
                             'retry': retry_num,
                             'message': error_msg,
                             'timestamp': start_time,
-                            'data': b64_data,
+                            'data': payload,
+                            'timings': trace,
                             'duration': int((datetime.utcnow() - start_time).total_seconds() * 1000)
                         })
                         try:
-                            if response is not None:
+                            # A streamed body is released by the caller
+                            if response is not None and not slots.detached:
                                 await response.release()
                         except (aiohttp.DisconnectedError, RuntimeError):
                             # Ignore disconnect errors on release
@@ -100,12 +199,58 @@ class RequestMixin():
                             pass
             if error_msg is not None:
                 self.logger.warn(error_msg)
+                if retry_num + 1 < self.config.MAX_RETRIES:
+                    # Back off without holding a host or global slot
+                    await asyncio.sleep(self.get_retry_delay(retry_num))
         if response is None:
             raise HttpConnectionError(error_msg)
         if raise_for_status:
             self.check_status(response, url)
         return response
 
+    def trace_request(self, host, response, started, headers_received, body_read=None,
+                      content=None):
+        if self.request_tracer is None:
+            return None
+        request = getattr(response, 'request', None)
+        trace = make_request_trace(getattr(request, 'trace', None), started,
+                                   headers_received, body_read)
+        self.request_tracer.add(
+            host, trace,
+            bytes_in=len(content) if content is not None else None,
+            bytes_out=get_body_size(getattr(request, 'body', None))
+        )
+        return trace
+
+    def log_trace_summary(self, host_count=10):
+        if self.request_tracer is None:
+            return
+        summary = self.request_tracer.get_summary()
+        busiest = sorted(summary.items(), key=lambda x: x[1]['requests'], reverse=True)
+        for host, info in busiest[:host_count]:
+            phases = info['phases']
+            self.logger.info(
+                '%s: %d requests (%d%% reused), total p50/p95 %s/%s ms, '
+                'ttfb p95 %s ms, connect p95 %s ms, %d bytes in',
+                host, info['requests'], 100 * info.get('reused', 0) // info['requests'],
+                phases['total']['p50'], phases['total']['p95'],
+                phases['ttfb']['p95'], phases['connect']['p95'],
+                info.get('bytes_in', 0))
+        if self.config.TRACE_DUMP_PATH:
+            self.request_tracer.dump(self.config.TRACE_DUMP_PATH)
+
+    def record_request_outcome(self, host_throttle, latency, error):
+        for limiter in (self.http_semaphore, host_throttle.limiter):
+            if isinstance(limiter, AdaptiveLimiter):
+                limiter.record(latency, error=error)
+
+    def update_host_throttle(self, host_throttle, response):
+        retry_after = response.headers.get(hdrs.RETRY_AFTER)
+        if response.status == 429 or (retry_after and response.status >= 400):
+            host_throttle.slow_down(parse_retry_after(retry_after))
+        else:
+            host_throttle.speed_up()
+
     def check_status(self, response, url):
         http_error_msg = ''
         if 400 <= response.status < 500:
@@ -129,11 +274,24 @@ class RequestMixin():
     def create_session(self, **kwargs):
         kwargs.setdefault('response_class', ScrapaClientResponse)
         kwargs.setdefault('request_class', ScrapaClientRequest)
-        connector = self.get_connector()
         request_kwargs = self.get_default_session_kwargs()
         request_kwargs.update(kwargs)
+        proxy = None
+        proxy_url = self.config.PROXY
+        if self.proxy_pool is not None:
+            proxy = self.proxy_pool.choose(self.get_proxy_loads())
+            proxy_url = proxy.url
+        if self.config.SHARE_CONNECTOR:
+            connector = self.get_shared_connector(proxy_url)
+            session_class = SharedConnectorSession
+        else:
+            connector = self.get_connector(proxy_url)
+            session_class = aiohttp.ClientSession
         self.logger.debug('Creating new session with %s and %s', connector, request_kwargs)
-        return SessionWrapper(self, aiohttp.ClientSession(connector=connector, **request_kwargs))
+        session = session_class(connector=connector, **request_kwargs)
+        # Sessions stay on one proxy so their cookies match the exit IP
+        session._proxy = proxy
+        return SessionWrapper(self, session)
 
     @contextmanager
     def get_session(self, **kwargs):
@@ -154,6 +312,11 @@ class RequestMixin():
         if session is not None and getattr(session, '_use_count', 0) > self.config.REUSE_SESSION_COUNT:
             session.close()
 
+        if session is not None and not session.closed:
+            proxy = getattr(session, '_proxy', None)
+            if proxy is not None and proxy.ejected:
+                session.close()
+
         if session is None or session.closed:
             self._session_pool[pool_index] = self.create_session()
             session = self._session_pool[pool_index]
@@ -181,55 +344,196 @@ class RequestMixin():
             else:
                 current_session._use_count += 1
 
-    def get_connector(self):
+    def get_proxy_loads(self):
+        loads = Counter()
+        for session in self._session_pool:
+            if session is not None and not session.closed:
+                loads[getattr(session, '_proxy', None)] += 1
+        return loads
+
+    def record_proxy_outcome(self, session, latency, error):
+        proxy = getattr(session, '_proxy', None)
+        if proxy is None:
+            return
+        change = self.proxy_pool.record(proxy, latency, error)
+        if change == 'ejected':
+            self.logger.warn('Ejected proxy %s (success rate %.2f)', proxy.url,
+                             proxy.success_rate)
+        elif change == 'reinstated':
+            self.logger.info('Reinstated proxy %s', proxy.url)
+
+    def log_proxy_stats(self):
+        if self.proxy_pool is None:
+            return
+        for proxy in self.proxy_pool.proxies:
+            self.logger.info('Proxy %s: %d requests, success rate %.2f, latency %.2fs%s',
+                             proxy.url, proxy.requests, proxy.success_rate, proxy.latency,
+                             ' (ejected)' if proxy.ejected else '')
+
+    def get_shared_connector(self, proxy_url=None):
+        """
+        One connector per proxy (or one without a proxy) for all sessions,
+        so sessions keep separate cookies but share keep-alive connections
+        and the DNS cache.
+        """
+        connector = self.connectors.get(proxy_url)
+        if connector is None or connector.closed:
+            connector = self.connectors[proxy_url] = self.get_connector(proxy_url)
+            self.dns_cache_cleared = time.monotonic()
+        return connector
+
+    def refresh_dns_cache(self):
+        """Forget resolved hosts of the shared connectors every DNS_CACHE_TTL seconds."""
+        if not self.connectors or not self.config.DNS_CACHE_TTL:
+            return
+        if time.monotonic() - self.dns_cache_cleared >= self.config.DNS_CACHE_TTL:
+            for connector in self.connectors.values():
+                connector.clear_dns_cache()
+            self.dns_cache_cleared = time.monotonic()
+
+    def log_connection_stats(self):
+        requests = sum(c.connection_requests for c in self.connectors.values())
+        if not requests:
+            return
+        created = sum(c.connections_created for c in self.connectors.values())
+        self.logger.info('Connections: %d requests, %d opened (%.0f%% reused)',
+                         requests, created, (1 - created / requests) * 100)
+
+    def close_connectors(self):
+        for connector in self.connectors.values():
+            connector.close()
+        self.connectors = {}
+
+    def get_connector(self, proxy_url=None):
         custom_kwargs = {
-            'verify_ssl': self.config.VERIFY_SSL
+            'verify_ssl': self.config.VERIFY_SSL,
+            'keepalive_timeout': self.config.KEEPALIVE_TIMEOUT,
+            'use_dns_cache': self.config.DNS_CACHE_TTL is not None
         }
 
         if self.config.CUSTOM_CA:
             ssl_ctx = ssl.create_default_context(cafile=self.config.CUSTOM_CA)
             custom_kwargs['ssl_context'] = ssl_ctx
 
-        if self.config.PROXY is not None:
-            conn = aiohttp.connector.ProxyConnector(
-                proxy=self.config.PROXY,
+        if proxy_url is None:
+            proxy_url = self.config.PROXY
+
+        if proxy_url is not None:
+            conn = ScrapaProxyConnector(
+                proxy=proxy_url,
                 conn_timeout=self.config.CONNECT_TIMEOUT,
                 limit=self.config.CONNECTOR_LIMIT,
                 **custom_kwargs)
         else:
-            conn = aiohttp.TCPConnector(
+            conn = ScrapaTCPConnector(
                 conn_timeout=self.config.CONNECT_TIMEOUT,
                 limit=self.config.CONNECTOR_LIMIT,
                 **custom_kwargs
             )
         return conn
 
-    async def get(self, url='', *args, **kwargs):
+    def get_request_fingerprint(self, method, url, kwargs):
+        session = kwargs.get('session')
+        headers = dict(getattr(session, '_default_headers', None) or {})
+        headers.update(kwargs.get('headers') or {})
+        return get_request_fingerprint(
+            method, self.get_full_url(url),
+            params=kwargs.get('params'),
+            data=kwargs.get('data'),
+            json_data=kwargs.get('json'),
+            headers=headers,
+            key_headers=self.config.CACHE_KEY_HEADERS
+        )
+
+    async def cached_request(self, cache_id, method, url, cache_ttl=None, **kwargs):
         cache_url = self.get_full_url(url, params=kwargs.get('params', {}))
-        cache = kwargs.pop('cache', False)
-        if cache:
-            start_time = datetime.utcnow()
-            cache_id = get_cache_id(cache_url, *args, **kwargs)
-            cached_result = await self.get_cached_content(cache_id)
-            if cached_result is not None:
-                self.log_request({
-                    'req_uuid': str(uuid.uuid4()),
-                    'method': 'GET',
-                    'kwargs': kwargs,
-                    'session_id': None,
-                    'url': cache_url,
-                    'status': 200,
-                    'retry': 0,
-                    'message': None,
-                    'timestamp': start_time,
-                    'data': cached_result.decode('utf-8', 'replace'),
-                    'duration': int((datetime.utcnow() - start_time).total_seconds() * 1000)
-                })
-
-                return CachedResponse(self, cache_url, cached_result)
+        start_time = datetime.utcnow()
+        cache_entry = await self.get_cache_entry(cache_id)
+        if cache_entry is not None and is_fresh(cache_entry):
+            self.cache_stats['hits'] += 1
+            self.log_request({
+                'req_uuid': str(uuid.uuid4()),
+                'method': method,
+                'kwargs': kwargs,
+                'session_id': None,
+                'url': cache_url,
+                'status': cache_entry['status'],
+                'retry': 0,
+                'message': None,
+                'timestamp': start_time,
+                'data': self.capture_payload(urlsplit(cache_url).netloc.lower(),
+                                             cache_entry['content']),
+                'duration': int((datetime.utcnow() - start_time).total_seconds() * 1000)
+            })
+
+            return CachedResponse(self, cache_url, cache_entry['content'],
+                                  status=cache_entry['status'],
+                                  headers=cache_entry['headers'])
+        self.cache_stats['misses'] += 1
+        inflight = self.inflight_requests.get(cache_id)
+        if inflight is not None:
+            result = await asyncio.shield(inflight)
+            if result is not None:
+                return CachedResponse(self, cache_url, *result)
+        if cache_entry is not None and (
+                method.upper() not in CONDITIONAL_METHODS or
+                not (cache_entry['etag'] or cache_entry['last_modified'])):
+            # Nothing to revalidate with, other methods get 412 instead of 304
+            cache_entry = None
+        return (await self.get_single_flight(cache_id, method, url,
+                                             cache_ttl=cache_ttl,
+                                             cache_entry=cache_entry, **kwargs))
+
+    async def get_single_flight(self, cache_id, method, url, cache_ttl=None,
+                                cache_entry=None, **kwargs):
+        """
+        Fetch and cache url while concurrent requests of the same cache id
+        wait for the content (or the error) of this request. At most
+        INFLIGHT_REQUEST_LIMIT requests are shared at the same time.
+        An expired cache_entry is revalidated with a conditional request
+        and served from the cache if the server answers 304.
+        """
+        future = None
+        if (cache_id not in self.inflight_requests and
+                len(self.inflight_requests) < self.config.INFLIGHT_REQUEST_LIMIT):
+            future = asyncio.Future()
+            self.inflight_requests[cache_id] = future
+        if cache_entry is not None:
+            kwargs['headers'] = get_conditional_headers(cache_entry,
+                                                        kwargs.get('headers'))
+        try:
+            response = await self.send_request(method, url, **kwargs)
+            if cache_entry is not None and response.status == 304:
+                await self.revalidate_cached_content(cache_id, response,
+                                                     ttl=cache_ttl)
+                response = CachedResponse(self, response.url, cache_entry['content'],
+                                          status=cache_entry['status'],
+                                          headers=cache_entry['headers'])
+            else:
+                await self.set_cached_content(cache_id, response.url, response,
+                                              ttl=cache_ttl)
+        except asyncio.CancelledError:
+            if future is not None:
+                # Waiters make their own request
+                future.set_result(None)
+            raise
+        except Exception as e:
+            if future is not None:
+                future.set_exception(e)
+                # Don't complain about the error if nobody was waiting
+                future.exception()
+            raise
+        else:
+            if future is not None:
+                future.set_result((await response.read(), response.status,
+                                   response.headers))
+        finally:
+            if future is not None:
+                del self.inflight_requests[cache_id]
+        return response
+
+    async def get(self, url='', *args, **kwargs):
         response = await self.request('GET', url, *args, **kwargs)
-        if cache:
-            await self.set_cached_content(cache_id, response.url, response)
         return response
 
     async def get_text(self, url='', *args, **kwargs):
@@ -254,6 +558,157 @@ class RequestMixin():
         response = await self.request('POST', *args, **kwargs)
         return response
 
+    async def download(self, url='', path=None, sink=None, max_size=None,
+                       checksum='sha256', **kwargs):
+        """
+        Stream a GET response to the file at path or to sink (an object with
+        a write method that may be a coroutine) without holding the body in
+        memory. Interrupted transfers are resumed with If-Range requests
+        against the ETag or Last-Modified date of the first response, a
+        partial file at path is resumed from path + '.part'. Returns a dict
+        with the size and the hex digest of the body.
+        """
+        if (path is None) == (sink is None):
+            raise ValueError('Pass either path or sink')
+        if max_size is None:
+            max_size = self.config.DOWNLOAD_MAX_SIZE
+        transfer = {'size': 0, 'status': None, 'digest': hashlib.new(checksum),
+                    'validator': None, 'validator_path': None}
+        part_path = None
+        if path is not None:
+            part_path = path + '.part'
+            transfer['validator_path'] = part_path + '.validator'
+            if os.path.exists(part_path) and os.path.exists(transfer['validator_path']):
+                with open(transfer['validator_path']) as f:
+                    transfer['validator'] = f.read() or None
+            if transfer['validator'] is not None:
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.config.DOWNLOAD_CHUNK_SIZE), b''):
+                        transfer['digest'].update(chunk)
+                        transfer['size'] += len(chunk)
+            sink = open(part_path, 'ab')
+            if transfer['size'] == 0:
+                # A partial file without validator can't be resumed safely
+                sink.truncate(0)
+        headers = dict(kwargs.pop('headers', None) or {})
+        error_msg = None
+        try:
+            for retry_num in range(self.config.MAX_RETRIES):
+                headers.pop(hdrs.RANGE, None)
+                headers.pop(hdrs.IF_RANGE, None)
+                if transfer['size'] > 0 and transfer['validator'] is None:
+                    # The body may have changed since, start over
+                    if not rewind_sink(sink, transfer):
+                        raise HttpConnectionError(error_msg)
+                if transfer['size'] > 0:
+                    headers[hdrs.RANGE] = 'bytes={}-'.format(transfer['size'])
+                    headers[hdrs.IF_RANGE] = transfer['validator']
+                response = await self.send_request('GET', url, headers=headers,
+                                                   stream=True, raise_for_status=False,
+                                                   **kwargs)
+                try:
+                    await self.stream_response(response, sink, transfer, max_size, url)
+                except (asyncio.TimeoutError, aiohttp.ClientError,
+                        aiohttp.DisconnectedError) as e:
+                    response.close()
+                    error_msg = 'Download of {} interrupted: {!r}'.format(url, e)
+                    self.logger.warn(error_msg)
+                    if retry_num + 1 < self.config.MAX_RETRIES:
+                        await asyncio.sleep(self.get_retry_delay(retry_num))
+                    continue
+                except DownloadSizeError:
+                    response.close()
+                    if part_path is not None:
+                        sink.close()
+                        os.remove(part_path)
+                        self.remove_validator(transfer)
+                    raise
+                except Exception:
+                    response.close()
+                    raise
+                await response.release()
+                break
+            else:
+                raise HttpConnectionError(error_msg)
+        finally:
+            if part_path is not None:
+                sink.close()
+        if part_path is not None:
+            os.replace(part_path, path)
+            self.remove_validator(transfer)
+        return {
+            'url': self.get_full_url(url),
+            'path': path,
+            'status': transfer['status'],
+            'size': transfer['size'],
+            'checksum': transfer['digest'].hexdigest()
+        }
+
+    async def stream_response(self, response, sink, transfer, max_size, url):
+        """
+        Write the body of response to sink and update the size and digest of
+        transfer. A full body in response to a resume starts the transfer
+        over, or skips the bytes already written if sink can't seek and the
+        body is unchanged.
+        """
+        offset = transfer['size']
+        transfer['status'] = response.status
+        start, total = parse_content_range(response.headers.get(hdrs.CONTENT_RANGE))
+        if response.status == 416 and offset > 0 and total == offset:
+            # The partial file already is complete
+            return
+        self.check_status(response, url)
+        skip = 0
+        if response.status == 206 and start != offset:
+            raise HttpError(code=response.status, headers=response.headers,
+                            message='Unexpected Content-Range for url: {}'.format(url))
+        elif response.status != 206:
+            validator = get_range_validator(response.headers)
+            if offset > 0 and not rewind_sink(sink, transfer):
+                if validator is None or validator != transfer['validator']:
+                    raise HttpError(code=response.status, headers=response.headers,
+                                    message='Body changed while resuming url: {}'.format(url))
+                skip = offset
+            self.store_validator(transfer, validator)
+            offset = transfer['size']
+        length = response.headers.get(hdrs.CONTENT_LENGTH)
+        if max_size and length is not None and length.isdigit() and (
+                offset - skip + int(length) > max_size):
+            raise DownloadSizeError('{} is larger than {} bytes'.format(url, max_size))
+        while True:
+            chunk = await asyncio.wait_for(
+                response.content.read(self.config.DOWNLOAD_CHUNK_SIZE),
+                self.config.DOWNLOAD_READ_TIMEOUT)
+            if not chunk:
+                break
+            if skip:
+                skipped = min(skip, len(chunk))
+                chunk = chunk[skipped:]
+                skip -= skipped
+                if not chunk:
+                    continue
+            if max_size and transfer['size'] + len(chunk) > max_size:
+                raise DownloadSizeError('{} is larger than {} bytes'.format(url, max_size))
+            transfer['digest'].update(chunk)
+            result = sink.write(chunk)
+            if asyncio.iscoroutine(result):
+                await result
+            transfer['size'] += len(chunk)
+
+    def store_validator(self, transfer, validator):
+        transfer['validator'] = validator
+        if transfer['validator_path'] is None:
+            return
+        if validator is None:
+            self.remove_validator(transfer)
+            return
+        with open(transfer['validator_path'], 'w') as f:
+            f.write(validator)
+
+    def remove_validator(self, transfer):
+        if transfer['validator_path'] is not None and os.path.exists(transfer['validator_path']):
+            os.remove(transfer['validator_path'])
+
     def get_full_url(self, url, base_url=None, params=None):
         if base_url is None:
             base_url = self.config.BASE_URL
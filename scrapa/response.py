@@ -4,7 +4,7 @@ from lxml import html
 from lxml import etree
 
 from aiohttp.client import ClientResponse
-from aiohttp import hdrs, helpers
+from aiohttp import hdrs, helpers, CIMultiDict
 
 from .utils import show_in_browser
 
@@ -20,6 +20,26 @@ html_parser.set_element_class_lookup(parser_lookup)
 
 
 class ScrapaClientResponse(ClientResponse):
+    # Called once when a streamed response is released or closed
+    on_release = None
+
+    def close(self, *args, **kwargs):
+        try:
+            return super(ScrapaClientResponse, self).close(*args, **kwargs)
+        finally:
+            self.release_slots()
+
+    async def release(self):
+        try:
+            return (await super(ScrapaClientResponse, self).release())
+        finally:
+            self.release_slots()
+
+    def release_slots(self):
+        on_release, self.on_release = self.on_release, None
+        if on_release is not None:
+            on_release()
+
     def get_mimetype(self):
         ctype = self.headers.get(hdrs.CONTENT_TYPE, '').lower()
         return helpers.parse_mimetype(ctype)
@@ -79,11 +99,12 @@ class ScrapaClientResponse(ClientResponse):
 
 
 class CachedResponse(ScrapaClientResponse):
-    def __init__(self, scrapa, url, content):
+    def __init__(self, scrapa, url, content, status=200, headers=None):
         self.scrapa = scrapa
         self.url = url
         self._content = content
-        self.status = 200
+        self.status = status
+        self.headers = CIMultiDict(headers or {})
 
     def _get_encoding(self):
         return 'utf-8'
@@ -9,6 +9,8 @@ from .logger import LoggingMixin, add_websocket_handler
 from .queue import QueueMixin
 from .request import RequestMixin
 from .storage import StorageMixin
+from .task import Task
+from .workers import WorkerMixin
 
 
 if not hasattr(asyncio, 'ensure_future'):
@@ -21,6 +23,7 @@ class Scraper(ConfigurationMixin,
               RequestMixin,
               QueueMixin,
               StorageMixin,
+              WorkerMixin,
               object):
     def __init__(self, **kwargs):
         self.config_kwargs = kwargs
@@ -47,12 +50,30 @@ class Scraper(ConfigurationMixin,
                     'task_count': self.tasks_running,
                     'consumer_count': self.consumer_count
                 })
+                if self.config.ADAPTIVE_CONCURRENCY:
+                    self.log_concurrency()
+                self.log_stuck_tasks()
+                self.refresh_dns_cache()
+                if (self.config.CACHE_MAX_SIZE or self.config.CACHE_TTL is not None or
+                        self.config.CACHE_USE_HEADERS):
+                    self.start_cache_eviction()
+                self.report_worker_stats()
+                if self.config.TASK_LEASING:
+                    await self.renew_leases()
             if self.stopping:
                 break
+            if self.queue_finished():
+                await self.wait_for_refill()
             if self.queue_finished():
                 await self.queue_pending_tasks()
-                if self.queue_finished():
+                if not self.queue_finished():
+                    self.set_worker_busy(True)
+                elif await self.can_stop_worker():
                     break
+            elif self.queue.qsize() < self.get_refill_threshold():
+                # Leases of other nodes may have expired since
+                self.leases_exhausted = False
+                self.refill_queue()
             await asyncio.sleep(self.config.PROGRESS_INTERVAL)
         if self.stopping:
             self.logger.info('Stopping, cleaning up...')
@@ -60,11 +81,31 @@ class Scraper(ConfigurationMixin,
             self.logger.info('All tasks finished, cleaning up...')
         await self.clean_up()
 
+    def log_concurrency(self):
+        host_limits = ', '.join(
+            '{}={}'.format(host, throttle.limiter.limit)
+            for host, throttle in sorted(self.host_scheduler.hosts.items())
+            if throttle.limiter.active > 0
+        )
+        self.logger.info('Concurrency limit: %s (active hosts: %s)',
+                         self.http_semaphore.limit, host_limits or '-')
+
     async def clean_up(self):
-        self.terminate_consumers = True
+        if self.refill_future is not None:
+            self.refill_future.cancel()
+        if self.eviction_future is not None:
+            self.eviction_future.cancel()
+        self.log_cache_stats()
+        await self.stop_consumers()
+        if self.config.TASK_LEASING:
+            await self.release_leases()
         for session in self._session_pool:
             if session is not None and not session.closed:
                 session.close()
+        self.log_connection_stats()
+        self.log_trace_summary()
+        self.log_proxy_stats()
+        self.close_connectors()
         if self.config.ENABLE_WEBSERVER:
             await self.websocket_handler.close_server()
         return None
@@ -72,7 +113,9 @@ class Scraper(ConfigurationMixin,
     def start(self):
         raise NotImplementedError
 
-    def scrape(self, **kwargs):
+    def scrape(self, workers=1, **kwargs):
+        if workers > 1:
+            return self.scrape_workers(workers, **kwargs)
         self.init_configuration(kwargs)
         loop = asyncio.get_event_loop()
 
@@ -96,17 +139,25 @@ class Scraper(ConfigurationMixin,
             if clear and task_count > 0:
                 self.logger.info('Deleting %s tasks...', task_count)
                 await storage.clear_tasks(self.config.NAME)
+            await self.load_task_filter()
             self.logger.info('Starting scraper from scratch')
             await self.run_start()
         else:
-            pending_task_count = await storage.get_pending_task_count(self.config.NAME)
-            if pending_task_count == 0:
-                self.logger.info('All %d tasks are complete.', task_count)
-                return
-            self.logger.info('Resuming scraper with %d/%d pending tasks',
-                             pending_task_count, task_count)
-            await self.queue_pending_tasks()
-            await self.run()
+            await self.resume()
+
+    async def resume(self):
+        storage = await self.get_storage()
+        task_count = await storage.get_task_count(self.config.NAME)
+        pending_task_count = await storage.get_pending_task_count(self.config.NAME)
+        if pending_task_count == 0:
+            self.logger.info('All %d tasks are complete.', task_count)
+            return
+        self.logger.info('Resuming scraper with %d/%d pending tasks',
+                         pending_task_count, task_count)
+        await self.load_task_filter()
+        # Load the first page while the consumers start, puts block on a full queue
+        self.refill_future = asyncio.ensure_future(self.queue_pending_tasks())
+        await self.run()
 
     async def run(self, start_coro=None):
         if self.config.ENABLE_WEBSERVER:
@@ -114,12 +165,12 @@ class Scraper(ConfigurationMixin,
 
         consumers = []
         if self.config.ENABLE_QUEUE:
-            self.terminate_consumers = False
             consumers = [self.consume_queue() for _ in range(self.config.CONSUMER_COUNT)]
 
         start = []
         if start_coro is not None:
-            start = [self.run_task(start_coro)]
+            # Seeding may take long, TASK_TIMEOUT is for queued tasks
+            start = [self.execute_task(Task(start_coro, (), {}), deadline=False)]
 
         self.stats = {'counter': Counter(), 'start_time': datetime.utcnow()}
 
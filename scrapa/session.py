@@ -18,3 +18,6 @@ class SessionWrapper():
 
     async def request(self, *args, **kwargs):
         return await self._run('request', *args, **kwargs)
+
+    async def download(self, *args, **kwargs):
+        return await self._run('download', *args, **kwargs)
@@ -0,0 +1,102 @@
+from collections import deque
+import os
+import shutil
+import tempfile
+
+
+def get_spill_root(directory=None):
+    return directory or os.path.join(tempfile.gettempdir(), 'scrapa-spill')
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def remove_stale_spills(root):
+    """Remove the segment directories of processes that are gone."""
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        pid = name.rsplit('-', 1)[-1]
+        if pid.isdigit() and not pid_alive(int(pid)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+class SegmentSpill():
+    """
+    Append-only overflow for queue entries. Lines are written to numbered
+    segment files of at most segment_size lines and read back in the
+    order they were written. Segments are deleted once they are read.
+    The directory belongs to this process and is removed on close or by
+    remove_stale_spills after a crash.
+    """
+    def __init__(self, root, name, segment_size=10000):
+        self.root = root
+        self.directory = os.path.join(root, '{}-{}'.format(name, os.getpid()))
+        self.segment_size = segment_size
+        self.segments = deque()
+        self.segment_counter = 0
+        self.writer = None
+        self.write_count = 0
+        self.reader = None
+        self.count = 0
+        remove_stale_spills(root)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, line):
+        if self.writer is None or self.write_count >= self.segment_size:
+            self._open_segment()
+        self.writer.write(line)
+        self.writer.write('\n')
+        self.write_count += 1
+        self.count += 1
+
+    def pop_many(self, limit):
+        lines = []
+        while len(lines) < limit and self.count:
+            if self.reader is None:
+                if self.writer is not None and self.writer.name == self.segments[0]:
+                    # Reading caught up with writing, start a new segment
+                    self.writer.close()
+                    self.writer = None
+                self.reader = open(self.segments[0], encoding='utf-8')
+            line = self.reader.readline()
+            if not line:
+                self.reader.close()
+                self.reader = None
+                os.remove(self.segments.popleft())
+                continue
+            lines.append(line)
+            self.count -= 1
+        return lines
+
+    def clear(self):
+        for handle in (self.writer, self.reader):
+            if handle is not None:
+                handle.close()
+        self.writer = None
+        self.reader = None
+        self.segments.clear()
+        self.count = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    close = clear
+
+    def _open_segment(self):
+        if self.writer is not None:
+            self.writer.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.segment_counter += 1
+        path = os.path.join(self.directory,
+                            '{:08d}.jsonl'.format(self.segment_counter))
+        self.writer = open(path, 'w', encoding='utf-8')
+        self.write_count = 0
+        self.segments.append(path)
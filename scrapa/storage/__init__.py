@@ -1,3 +1,10 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from aiohttp import hdrs
+
+from ..bloom import BloomFilter
+from ..cache import get_header_ttl, is_storable
 from .base import BaseStorage  # noqa
 from .dummy import DummyStorage  # noqa
 try:
@@ -23,15 +30,119 @@ class StorageMixin():
     def storage_enabled(self, coro):
         return getattr(coro, 'store', False) and self.config.STORAGE_ENABLED
 
-    async def store_task(self, coro, args, kwargs):
+    def get_task_lease(self):
+        """Newly stored tasks are leased to us if we are going to run them."""
+        if self.config.TASK_LEASING and self.worker_index is not None:
+            return (self.lease_owner, self.config.LEASE_DURATION)
+        return None
+
+    async def load_task_filter(self):
+        """
+        Fill an in-memory Bloom filter with all stored task ids so that new
+        tasks are inserted without asking storage first. Tasks in the filter
+        (or false positives, see DEDUP_FILTER_ERROR_RATE) are rejected in
+        memory if they are among the last DEDUP_RECENT_SIZE task ids seen and
+        checked in storage otherwise.
+        """
+        if not self.config.DEDUP_FILTER:
+            return
+        storage = await self.get_storage()
+        task_count = await storage.get_task_count(self.config.NAME)
+        self.task_filter = BloomFilter(
+            max(self.config.DEDUP_FILTER_CAPACITY, task_count * 2),
+            error_rate=self.config.DEDUP_FILTER_ERROR_RATE,
+            max_bytes=self.config.DEDUP_FILTER_MAX_BYTES
+        )
+        self.recent_task_ids.clear()
+        for task_id in await storage.get_task_ids(self.config.NAME):
+            self.remember_task_id(task_id)
+        self.logger.info('Loaded %d task ids into dedup filter (%d bytes)',
+                         self.task_filter.count, len(self.task_filter.bits))
+
+    def is_known_task(self, task_id):
+        """True if task_id is certainly stored already."""
+        if task_id not in self.recent_task_ids:
+            return False
+        self.recent_task_ids.move_to_end(task_id)
+        return True
+
+    def remember_task_id(self, task_id):
+        self.task_filter.add(task_id)
+        self.recent_task_ids[task_id] = None
+        self.recent_task_ids.move_to_end(task_id)
+        if len(self.recent_task_ids) > self.config.DEDUP_RECENT_SIZE:
+            self.recent_task_ids.popitem(last=False)
+
+    async def store_task(self, task):
         storage = await self.get_storage()
-        should_run = await storage.store_task(self.config.NAME, coro, args, kwargs)
+        storage.get_record_id(task)
+        is_new = False
+        if self.task_filter is not None:
+            if task.task_id in self.task_filter:
+                if self.is_known_task(task.task_id):
+                    return False
+            else:
+                is_new = True
+        should_run = await storage.store_task(self.config.NAME, task.coro,
+                                              task.args, task.kwargs,
+                                              priority=task.priority,
+                                              lease=self.get_task_lease(),
+                                              task_id=task.task_id,
+                                              is_new=is_new)
+        if self.task_filter is not None:
+            self.remember_task_id(task.task_id)
         return should_run
 
+    async def store_tasks(self, tasks):
+        storage = await self.get_storage()
+        new_task_ids = None
+        if self.task_filter is not None:
+            new_task_ids = set()
+            unknown = []
+            for task in tasks:
+                task_id = storage.get_record_id(task)
+                if task_id not in self.task_filter:
+                    new_task_ids.add(task_id)
+                elif self.is_known_task(task_id):
+                    continue
+                unknown.append(task)
+            tasks = unknown
+            if not tasks:
+                return set()
+        stored = await storage.store_tasks(self.config.NAME, tasks,
+                                           lease=self.get_task_lease(),
+                                           new_task_ids=new_task_ids)
+        if self.task_filter is not None:
+            for task in tasks:
+                self.remember_task_id(task.task_id)
+        return stored
+
+    async def lease_tasks(self):
+        storage = await self.get_storage()
+        return await storage.lease_tasks(self.config.NAME, self.lease_owner,
+                                         self.config.LEASE_BATCH_SIZE,
+                                         self.config.LEASE_DURATION,
+                                         max_tries=self.config.TASK_RETRY_COUNT)
+
+    async def renew_leases(self):
+        storage = await self.get_storage()
+        await storage.renew_leases(self.config.NAME, self.lease_owner,
+                                   self.config.LEASE_DURATION)
+
+    async def release_leases(self):
+        storage = await self.get_storage()
+        await storage.release_leases(self.config.NAME, self.lease_owner)
+
     async def store_task_result(self, *args, **kwargs):
         storage = await self.get_storage()
         await storage.store_task_result(*args, **kwargs)
 
+    async def store_task_retry(self, task, next_attempt):
+        storage = await self.get_storage()
+        await storage.store_task_retry(self.config.NAME, task.coro, task.args,
+                                       task.kwargs, next_attempt,
+                                       task_id=task.task_id)
+
     async def has_result(self, result_id, kind):
         storage = await self.get_storage()
         return await storage.has_result(self.config.NAME, result_id, kind)
@@ -49,7 +160,70 @@ class StorageMixin():
         result = await storage.get_cached_content(cache_id)
         return result
 
-    async def set_cached_content(self, cache_id, url, response):
+    async def get_cache_entry(self, cache_id):
+        storage = await self.get_storage()
+        return await storage.get_cache_entry(cache_id)
+
+    def get_cache_expiry(self, headers, ttl=None):
+        """
+        Return the expiry datetime for ttl seconds. Without ttl the
+        Cache-Control and Expires headers are used if CACHE_USE_HEADERS is
+        set, then CACHE_TTL. None means the entry doesn't expire.
+        """
+        if ttl is None and self.config.CACHE_USE_HEADERS:
+            ttl = get_header_ttl(headers)
+        if ttl is None:
+            ttl = self.config.CACHE_TTL
+        if ttl is None:
+            return None
+        return datetime.now() + timedelta(seconds=ttl)
+
+    async def set_cached_content(self, cache_id, url, response, ttl=None):
+        headers = getattr(response, 'headers', None) or {}
+        if ttl is None and self.config.CACHE_USE_HEADERS and not is_storable(headers):
+            return
         content = await response.read()
         storage = await self.get_storage()
-        await storage.set_cached_content(cache_id, url, content)
+        await storage.set_cached_content(
+            cache_id, url, content,
+            expires=self.get_cache_expiry(headers, ttl),
+            status=getattr(response, 'status', 200),
+            headers=dict(headers),
+            etag=headers.get(hdrs.ETAG),
+            last_modified=headers.get(hdrs.LAST_MODIFIED)
+        )
+        self.cache_stats['stores'] += 1
+
+    async def revalidate_cached_content(self, cache_id, response, ttl=None):
+        """The server confirmed the cached entry with a 304."""
+        storage = await self.get_storage()
+        await storage.touch_cached_content(
+            cache_id, expires=self.get_cache_expiry(response.headers, ttl))
+        self.cache_stats['revalidated'] += 1
+
+    def start_cache_eviction(self):
+        """Evict expired and surplus cache entries in the background."""
+        if self.eviction_future is not None and not self.eviction_future.done():
+            return
+        self.eviction_future = asyncio.ensure_future(self.evict_cache())
+
+    async def evict_cache(self):
+        storage = await self.get_storage()
+        while True:
+            deleted = await storage.evict_cache(
+                self.config.CACHE_MAX_SIZE,
+                policy=self.config.CACHE_EVICTION_POLICY,
+                limit=self.config.CACHE_EVICTION_BATCH
+            )
+            self.cache_stats['evictions'] += deleted
+            if not deleted:
+                break
+            # Give other tasks a turn between batches
+            await asyncio.sleep(0)
+
+    def log_cache_stats(self):
+        if not any(self.cache_stats.values()):
+            return
+        self.logger.info('HTTP cache: {hits} hits, {misses} misses, {revalidated} '
+                         'revalidated, {stores} stored, {evictions} evicted'.format_map(
+                             self.cache_stats))
@@ -1,11 +1,13 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from aiopg.sa import create_engine
 import psycopg2
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.schema import CreateTable, CreateIndex
 
-from .base import BaseStorage, GeneratorWrapper as GW
+from .base import BaseStorage, GeneratorWrapper as GW, get_task_bucket
+from .blobs import BlobStore
 from ..utils import json_loads, json_dumps
 
 
@@ -18,6 +20,7 @@ task_table = sa.Table('scrapa_task', metadata,
     sa.Column('name', sa.String(255)),
     sa.Column('args', sa.Text()),
     sa.Column('kwargs', sa.Text()),
+    sa.Column('priority', sa.Integer, default=0),
     sa.Column('created', sa.DateTime),
     sa.Column('last_tried', sa.DateTime, nullable=True),
     sa.Column('tried', sa.Integer, default=0),
@@ -25,10 +28,22 @@ task_table = sa.Table('scrapa_task', metadata,
     sa.Column('failed', sa.Boolean, default=False),
     sa.Column('value', sa.Text, nullable=True),
     sa.Column('exception', sa.Text, nullable=True),
+    sa.Column('lease_owner', sa.String(255), nullable=True),
+    sa.Column('lease_expires', sa.DateTime, nullable=True),
+    sa.Column('next_attempt', sa.DateTime, nullable=True),
+    sa.Column('bucket', sa.BigInteger, nullable=True),
 )
 
 task_index = sa.Index('scrapa_task__scraper_name_task_id', task_table.c.scraper_name, task_table.c.task_id, unique=True)
 
+# Rows stored before priorities existed have none
+TASK_PRIORITY = sa.func.coalesce(task_table.c.priority, 0)
+
+# Same as get_task_bucket for rows stored before buckets existed
+ADD_TASK_BUCKETS = '''UPDATE scrapa_task
+    SET bucket = ('x' || substr(task_id, 1, 8))::bit(32)::bigint
+    WHERE bucket IS NULL;'''
+
 result_table = sa.Table('scrapa_result', metadata,
     sa.Column('id', sa.Integer, primary_key=True),
     sa.Column('scraper_name', sa.String(255)),
@@ -44,7 +59,16 @@ cache_table = sa.Table('scrapa_cache', metadata,
     sa.Column('cache_id', sa.String(255)),
     sa.Column('url', sa.String(1024)),
     sa.Column('created', sa.DateTime),
-    sa.Column('content', sa.LargeBinary),
+    sa.Column('content', sa.LargeBinary, nullable=True),
+    sa.Column('content_hash', sa.String(64), nullable=True),
+    sa.Column('expires', sa.DateTime, nullable=True),
+    sa.Column('size', sa.Integer, default=0),
+    sa.Column('last_accessed', sa.DateTime),
+    sa.Column('hits', sa.Integer, default=0),
+    sa.Column('status', sa.Integer, default=200),
+    sa.Column('headers', sa.Text, nullable=True),
+    sa.Column('etag', sa.String(1024), nullable=True),
+    sa.Column('last_modified', sa.String(255), nullable=True),
 )
 
 cache_index = sa.Index('scrapa_cache__cache_id', cache_table.c.cache_id, unique=True)
@@ -52,6 +76,9 @@ cache_index = sa.Index('scrapa_cache__cache_id', cache_table.c.cache_id, unique=
 
 class AsyncPostgresStorage(BaseStorage):
     def __init__(self, **kwargs):
+        blob_path = kwargs.pop('blob_path', None)
+        if blob_path is not None:
+            self.blobs = BlobStore(blob_path)
         self.kwargs = kwargs
         self.tables = [(task_table, task_index),
                   (cache_table, cache_index),
@@ -80,29 +107,89 @@ class AsyncPostgresStorage(BaseStorage):
                         create_index = str(CreateIndex(index).compile(self.engine))
                         await conn.execute(create_index)
                     await tr.commit()
+                else:
+                    await self.add_missing_columns(conn, table, schema_name)
+
+    async def add_missing_columns(self, conn, table, schema_name):
+        """Add columns to tables created by older versions."""
+        result = await conn.execute('''SELECT column_name
+            FROM   information_schema.columns
+            WHERE  table_schema = '{table_schema}'
+            AND    table_name = '{table_name}';'''.format(table_schema=schema_name,
+                                                         table_name=table.name))
+        existing = set(row.column_name for row in result)
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            tr = await conn.begin()
+            await conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name, column.name, column.type.compile(dialect=self.engine.dialect)))
+            if column.default is not None and column.default.is_scalar:
+                await conn.execute(table.update().values(
+                    {column.name: column.default.arg}))
+            if column is task_table.c.bucket:
+                await conn.execute(ADD_TASK_BUCKETS)
+            await tr.commit()
+
+    def get_task_row(self, scraper_name, task_id, coro, args, kwargs,
+                     priority=0, lease=None):
+        row = dict(
+            scraper_name=scraper_name,
+            task_id=task_id,
+            name=coro.__name__,
+            args=json_dumps(args),
+            kwargs=json_dumps(kwargs),
+            priority=priority,
+            created=datetime.now(),
+            tried=0,
+            done=False,
+            failed=False,
+            value=None,
+            exception=None,
+            lease_owner=None,
+            lease_expires=None,
+            next_attempt=None,
+            bucket=get_task_bucket(task_id)
+        )
+        if lease is not None:
+            owner, duration = lease
+            row['lease_owner'] = owner
+            # Use the database clock for leases, nodes may disagree on time
+            row['lease_expires'] = sa.func.now() + timedelta(seconds=duration)
+        return row
 
-    async def store_task(self, scraper_name, coro, args, kwargs):
-        task_id = self.get_task_id(coro, args, kwargs)
+    async def store_task(self, scraper_name, coro, args, kwargs, priority=0,
+                         lease=None, task_id=None, is_new=False):
+        if task_id is None:
+            task_id = self.get_task_id(coro, args, kwargs)
         try:
             async with self.engine.acquire() as conn:
                 await conn.execute(task_table.insert().values(
-                    scraper_name=scraper_name,
-                    task_id=task_id,
-                    name=coro.__name__,
-                    args=json_dumps(args),
-                    kwargs=json_dumps(kwargs),
-                    created=datetime.now(),
-                    tried=0,
-                    done=False,
-                    failed=False,
-                    value=None,
-                    exception=None
+                    **self.get_task_row(scraper_name, task_id, coro, args,
+                                        kwargs, priority, lease)
                 ))
                 return True
         except psycopg2.IntegrityError:
             # Task already exists
             return False
 
+    async def store_tasks(self, scraper_name, tasks, lease=None, new_task_ids=None):
+        rows = {}
+        for task in tasks:
+            task_id = self.get_record_id(task)
+            rows[task_id] = self.get_task_row(scraper_name, task_id, task.coro,
+                                              task.args, task.kwargs,
+                                              task.priority, lease)
+        if not rows:
+            return set()
+        query = pg_insert(task_table).values(list(rows.values()))
+        query = query.on_conflict_do_nothing(
+            index_elements=[task_table.c.scraper_name, task_table.c.task_id]
+        ).returning(task_table.c.task_id)
+        async with self.engine.acquire() as conn:
+            result = await conn.execute(query)
+            return set(row.task_id for row in result)
+
     async def clear_tasks(self, scraper_name):
         async with self.engine.acquire() as conn:
             await conn.execute(
@@ -120,36 +207,108 @@ class AsyncPostgresStorage(BaseStorage):
             )
         return count
 
-    async def get_pending_task_count(self, scraper_name):
+    async def get_pending_task_count(self, scraper_name, max_tries=None):
+        query = [
+            task_table.c.scraper_name == scraper_name,
+            task_table.c.done == False  # noqa
+        ]
+        if max_tries is not None:
+            query.append(sa.func.coalesce(task_table.c.tried, 0) < max_tries)
         async with self.engine.acquire() as conn:
-            count = await conn.scalar(
-                task_table.count(sa.and_(
-                    task_table.c.scraper_name == scraper_name,
-                    task_table.c.done == False  # noqa
-                ))
-            )
+            count = await conn.scalar(task_table.count(sa.and_(*query)))
         return count
 
-    async def get_pending_tasks(self, scraper_name):
+    async def get_task_ids(self, scraper_name):
+        async with self.engine.acquire() as conn:
+            result = await conn.execute(
+                sa.select([task_table.c.task_id]).where(
+                    task_table.c.scraper_name == scraper_name
+                )
+            )
+            return [row.task_id for row in result]
+
+    async def get_pending_tasks(self, scraper_name, after=None, limit=None,
+                                until=None, shard=None):
+        query = [
+            task_table.c.scraper_name == scraper_name,
+            task_table.c.done == False  # noqa
+        ]
+        if shard is not None:
+            index, count = shard
+            query.append(task_table.c.bucket % count == index)
+        if after is not None:
+            priority, task_id = after
+            query.append(sa.or_(
+                TASK_PRIORITY < priority,
+                sa.and_(TASK_PRIORITY == priority,
+                        task_table.c.id > task_id)
+            ))
+        if until is not None:
+            query.append(task_table.c.created <= until)
         async with self.engine.acquire() as conn:
             result = await conn.execute(
                 task_table.select().where(
+                    sa.and_(*query)
+                ).order_by(
+                    TASK_PRIORITY.desc(), task_table.c.id
+                ).limit(limit)
+            )
+        return GW(self.get_task_dict(task) for task in result)
+
+    async def lease_tasks(self, scraper_name, owner, limit, duration, max_tries=None):
+        query = [
+            task_table.c.scraper_name == scraper_name,
+            task_table.c.done == False,  # noqa
+            sa.or_(task_table.c.lease_expires == None,  # noqa
+                   task_table.c.lease_expires < sa.func.now()),
+            sa.or_(task_table.c.next_attempt == None,  # noqa
+                   task_table.c.next_attempt <= datetime.now())
+        ]
+        if max_tries is not None:
+            query.append(sa.func.coalesce(task_table.c.tried, 0) < max_tries)
+        available = sa.select([task_table.c.id]).where(
+            sa.and_(*query)
+        ).order_by(
+            TASK_PRIORITY.desc(), task_table.c.id
+        ).limit(limit).with_for_update(skip_locked=True)
+        query = task_table.update().where(
+            task_table.c.id.in_(available)
+        ).values(
+            lease_owner=owner,
+            lease_expires=sa.func.now() + timedelta(seconds=duration)
+        ).returning(*task_table.c)
+        async with self.engine.acquire() as conn:
+            result = await conn.execute(query)
+            tasks = [self.get_task_dict(task) for task in result]
+        tasks.sort(key=lambda t: -t['priority'])
+        return tasks
+
+    async def renew_leases(self, scraper_name, owner, duration):
+        async with self.engine.acquire() as conn:
+            await conn.execute(
+                task_table.update().where(
                     sa.and_(
                         task_table.c.scraper_name == scraper_name,
-                        task_table.c.done == False  # noqa
+                        task_table.c.lease_owner == owner
                     )
-                )
+                ).values(lease_expires=sa.func.now() + timedelta(seconds=duration))
+            )
+
+    async def release_leases(self, scraper_name, owner):
+        async with self.engine.acquire() as conn:
+            await conn.execute(
+                task_table.update().where(
+                    sa.and_(
+                        task_table.c.scraper_name == scraper_name,
+                        task_table.c.lease_owner == owner
+                    )
+                ).values(lease_owner=None, lease_expires=None)
             )
-        return GW({
-            'task_name': task.name,
-            'args': json_loads(task.args),
-            'kwargs': json_loads(task.kwargs),
-            'meta': {'tried': task.tried}
-        } for task in result)
 
     async def store_task_result(self, scraper_name, coro, args, kwargs, done, failed,
-                          value, exception):
-        task_id = self.get_task_id(coro, args, kwargs)
+                          value, exception, task_id=None):
+        if task_id is None:
+            task_id = self.get_task_id(coro, args, kwargs)
         async with self.engine.acquire() as conn:
             await conn.execute(
                 task_table.update().where(
@@ -159,7 +318,23 @@ class AsyncPostgresStorage(BaseStorage):
                     )
                 ).values(**{'done': done, 'failed': failed,
                         'last_tried': datetime.now(), 'value': json_dumps(value),
-                        'exception': exception, 'tried': task_table.c.tried + 1})
+                        'exception': exception, 'tried': task_table.c.tried + 1,
+                        'lease_owner': None, 'lease_expires': None,
+                        'next_attempt': None})
+            )
+
+    async def store_task_retry(self, scraper_name, coro, args, kwargs,
+                               next_attempt, task_id=None):
+        if task_id is None:
+            task_id = self.get_task_id(coro, args, kwargs)
+        async with self.engine.acquire() as conn:
+            await conn.execute(
+                task_table.update().where(
+                    sa.and_(
+                        task_table.c.scraper_name == scraper_name,
+                        task_table.c.task_id == task_id
+                    )
+                ).values(next_attempt=next_attempt)
             )
 
     async def has_result(self, scraper_name, result_id, kind):
@@ -219,26 +394,137 @@ class AsyncPostgresStorage(BaseStorage):
                 return True
 
     async def get_cached_content(self, cache_id):
+        now = datetime.now()
         async with self.engine.acquire() as conn:
             result = await conn.execute(
-                cache_table.select().where(
-                    cache_table.c.cache_id == cache_id
-                )
+                cache_table.update().where(
+                    sa.and_(
+                        cache_table.c.cache_id == cache_id,
+                        sa.or_(cache_table.c.expires == None,  # noqa
+                               cache_table.c.expires > now)
+                    )
+                ).values(
+                    last_accessed=now,
+                    hits=sa.func.coalesce(cache_table.c.hits, 0) + 1
+                ).returning(cache_table.c.content, cache_table.c.content_hash)
             )
             if result.rowcount > 0:
-                return list(result)[0].content.tobytes()
+                return self.get_cache_content(list(result)[0])
             return None
 
-    async def set_cached_content(self, cache_id, url, content):
+    async def get_cache_entry(self, cache_id):
         async with self.engine.acquire() as conn:
-            await conn.execute(cache_table.insert().values(
-                cache_id=cache_id,
-                url=url,
-                created=datetime.now(),
-                content=content
-            ))
+            result = await conn.execute(
+                cache_table.update().where(
+                    cache_table.c.cache_id == cache_id
+                ).values(
+                    last_accessed=datetime.now(),
+                    hits=sa.func.coalesce(cache_table.c.hits, 0) + 1
+                ).returning(*cache_table.c)
+            )
+            rows = list(result)
+            if not rows:
+                return None
+            cache_dict = self.get_cache_dict(rows[0])
+            if cache_dict['content'] is None:
+                # Blob went missing
+                return None
+            return cache_dict
+
+    async def set_cached_content(self, cache_id, url, content, expires=None,
+                                 status=200, headers=None, etag=None,
+                                 last_modified=None):
+        now = datetime.now()
+        content_hash = None
+        if self.blobs is not None:
+            content_hash = self.blobs.put(content)
+        values = dict(
+            url=url,
+            created=now,
+            content=content if content_hash is None else None,
+            content_hash=content_hash,
+            expires=expires,
+            size=len(content),
+            last_accessed=now,
+            hits=0,
+            status=status,
+            headers=json_dumps(headers) if headers is not None else None,
+            etag=etag,
+            last_modified=last_modified
+        )
+        query = pg_insert(cache_table).values(cache_id=cache_id, **values)
+        query = query.on_conflict_do_update(
+            index_elements=[cache_table.c.cache_id], set_=values
+        )
+        async with self.engine.acquire() as conn:
+            old_hash = None
+            if self.blobs is not None:
+                old_hash = await conn.scalar(
+                    sa.select([cache_table.c.content_hash]).where(
+                        cache_table.c.cache_id == cache_id
+                    )
+                )
+            await conn.execute(query)
+            if old_hash != content_hash:
+                await self.delete_unused_blobs(conn, [old_hash])
+
+    async def delete_unused_blobs(self, conn, content_hashes):
+        if self.blobs is None:
+            return
+        for content_hash in set(content_hashes) - {None}:
+            used = await conn.scalar(
+                sa.select([sa.func.count()]).where(
+                    cache_table.c.content_hash == content_hash
+                )
+            )
+            if not used:
+                self.blobs.delete(content_hash)
+
+    async def touch_cached_content(self, cache_id, expires=None):
+        async with self.engine.acquire() as conn:
+            await conn.execute(
+                cache_table.update().where(
+                    cache_table.c.cache_id == cache_id
+                ).values(expires=expires, last_accessed=datetime.now())
+            )
+
+    async def evict_cache(self, max_size=0, policy='lru', limit=100):
+        async with self.engine.acquire() as conn:
+            # Expired entries with validators are kept for revalidation
+            result = await conn.execute(
+                cache_table.delete().where(cache_table.c.id.in_(
+                    sa.select([cache_table.c.id]).where(
+                        sa.and_(
+                            cache_table.c.expires <= datetime.now(),
+                            cache_table.c.etag == None,  # noqa
+                            cache_table.c.last_modified == None  # noqa
+                        )
+                    ).limit(limit)
+                )).returning(cache_table.c.content_hash)
+            )
+            content_hashes = [row.content_hash for row in result]
+            total_size = 0
+            if max_size:
+                total_size = await conn.scalar(
+                    sa.select([sa.func.coalesce(sa.func.sum(cache_table.c.size), 0)])
+                )
+            if total_size > max_size:
+                if policy == 'lfu':
+                    order = (cache_table.c.hits, cache_table.c.last_accessed)
+                else:
+                    order = (cache_table.c.last_accessed,)
+                result = await conn.execute(
+                    cache_table.delete().where(cache_table.c.id.in_(
+                        sa.select([cache_table.c.id]).order_by(*order).limit(limit)
+                    )).returning(cache_table.c.content_hash)
+                )
+                content_hashes += [row.content_hash for row in result]
+            await self.delete_unused_blobs(conn, content_hashes)
+            return len(content_hashes)
 
     async def clear_cache(self):
+        if self.blobs is not None:
+            self.blobs.clear()
         async with self.engine.acquire() as conn:
             await conn.execute(
                 cache_table.delete()
@@ -1,6 +1,13 @@
 import hashlib
 import json
 
+from ..utils import json_loads
+
+
+def get_task_bucket(task_id):
+    """Stored with every task to split pending tasks between workers."""
+    return int(task_id[:8], 16)
+
 
 class GeneratorWrapper(object):
     def __init__(self, gen):
@@ -11,6 +18,9 @@ class GeneratorWrapper(object):
 
 
 class BaseStorage(object):
+    # BlobStore for cached content, None keeps content in the database
+    blobs = None
+
     def get_task_id(self, coro, args, kwargs):
         task_id = hashlib.md5()
         task_id.update(coro.__name__.encode('utf-8'))
@@ -19,27 +29,101 @@ class BaseStorage(object):
         task_id.update(json.dumps(dump_kwargs, sort_keys=True).encode('utf-8'))
         return task_id.hexdigest()
 
+    def get_record_id(self, task):
+        """Return the id of a Task record, computing it only once."""
+        if task.task_id is None:
+            task.task_id = self.get_task_id(task.coro, task.args, task.kwargs)
+        return task.task_id
+
+    def get_task_dict(self, task):
+        return {
+            'task_id': task.task_id,
+            'task_name': task.name,
+            'args': json_loads(task.args),
+            'kwargs': json_loads(task.kwargs),
+            'priority': task.priority or 0,
+            'cursor': (task.priority or 0, task.id),
+            'next_attempt': task.next_attempt,
+            'meta': {'tried': task.tried}
+        }
+
     async def create(self):
         raise NotImplementedError
 
-    async def store_task(self, scraper_name, coro, args, kwargs):
-        """Return True if stored, False if already stored."""
+    async def store_task(self, scraper_name, coro, args, kwargs, priority=0,
+                         lease=None, task_id=None, is_new=False):
+        """
+        Return True if stored, False if already stored.
+        A new task is leased right away if lease is an (owner, seconds)
+        tuple. Pass task_id if it is already known and is_new to skip the
+        lookup of a task that is known not to be stored.
+        """
         raise NotImplementedError
 
+    async def store_tasks(self, scraper_name, tasks, lease=None, new_task_ids=None):
+        """
+        Store many Task records at once, tasks in new_task_ids are inserted
+        without checking for them first.
+        Return the set of task ids that were not stored before.
+        """
+        known_new = new_task_ids or set()
+        new_task_ids = set()
+        for task in tasks:
+            task_id = self.get_record_id(task)
+            stored = await self.store_task(scraper_name, task.coro, task.args,
+                                           task.kwargs, priority=task.priority,
+                                           lease=lease, task_id=task_id,
+                                           is_new=task_id in known_new)
+            if stored:
+                new_task_ids.add(task.task_id)
+        return new_task_ids
+
     async def clear_tasks(self, scraper_name):
         raise NotImplementedError
 
     async def get_task_count(self, scraper_name):
         raise NotImplementedError
 
-    async def get_pending_task_count(self, scraper_name):
+    async def get_pending_task_count(self, scraper_name, max_tries=None):
+        """Count tasks that are not done (and were tried less than max_tries)."""
+        raise NotImplementedError
+
+    async def get_task_ids(self, scraper_name):
+        """Return an iterable of all stored task ids."""
+        raise NotImplementedError
+
+    async def get_pending_tasks(self, scraper_name, after=None, limit=None,
+                                until=None, shard=None):
+        """
+        Return pending tasks, highest priority first. Pass the 'cursor'
+        of the last task of a page as after to get the next page. until
+        restricts the result to tasks created before that datetime, shard
+        (index, count) to tasks whose bucket modulo count is index.
+        """
+        raise NotImplementedError
+
+    async def lease_tasks(self, scraper_name, owner, limit, duration, max_tries=None):
+        """
+        Atomically lease up to limit pending tasks that are not leased or
+        whose lease expired to owner for duration seconds. Tasks tried
+        max_tries times are skipped. Returns the leased tasks like
+        get_pending_tasks.
+        """
         raise NotImplementedError
 
-    async def get_pending_tasks(self, scraper_name):
+    async def renew_leases(self, scraper_name, owner, duration):
+        raise NotImplementedError
+
+    async def release_leases(self, scraper_name, owner):
         raise NotImplementedError
 
     async def store_task_result(self, scraper_name, coro, args, kwargs, done, failed,
-                          value, exception):
+                          value, exception, task_id=None):
+        raise NotImplementedError
+
+    async def store_task_retry(self, scraper_name, coro, args, kwargs,
+                               next_attempt, task_id=None):
+        """Remember when a failed task should be tried again."""
         raise NotImplementedError
 
     async def has_result(self, scraper_name, result_id, kind):
@@ -51,10 +135,49 @@ class BaseStorage(object):
     async def store_result(self, scraper_name, result_id, kind, result):
         raise NotImplementedError
 
+    def get_cache_content(self, cached):
+        if cached.content_hash is not None and self.blobs is not None:
+            return self.blobs.get(cached.content_hash)
+        if cached.content is None:
+            return None
+        return bytes(cached.content)
+
+    def get_cache_dict(self, cached):
+        return {
+            'content': self.get_cache_content(cached),
+            'expires': cached.expires,
+            'status': cached.status or 200,
+            'headers': json_loads(cached.headers) if cached.headers else {},
+            'etag': cached.etag,
+            'last_modified': cached.last_modified
+        }
+
     async def get_cached_content(self, cache_id):
+        """Return the cached content or None if missing or expired."""
+        raise NotImplementedError
+
+    async def get_cache_entry(self, cache_id):
+        """
+        Return the cache entry as a dict (see get_cache_dict), even if it
+        expired, or None.
+        """
+        raise NotImplementedError
+
+    async def set_cached_content(self, cache_id, url, content, expires=None,
+                                 status=200, headers=None, etag=None,
+                                 last_modified=None):
+        raise NotImplementedError
+
+    async def touch_cached_content(self, cache_id, expires=None):
+        """Set a new expiry after the entry was revalidated."""
         raise NotImplementedError
 
-    async def set_cached_content(self, cache_id, url, content):
+    async def evict_cache(self, max_size=0, policy='lru', limit=100):
+        """
+        Delete up to limit expired entries and, while the cache is larger
+        than max_size bytes, up to limit entries by policy ('lru' or
+        'lfu'). Returns the number of deleted entries.
+        """
         raise NotImplementedError
 
     async def clear_cache(self):
@@ -0,0 +1,65 @@
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import zlib
+
+
+class BlobStore():
+    """
+    Compressed, content-addressed files under path. Blobs are named by
+    the SHA-256 of their content and sharded into two levels of
+    directories, so identical content is only stored once.
+    """
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+
+    def get_hash(self, content):
+        return hashlib.sha256(content).hexdigest()
+
+    def get_path(self, content_hash):
+        return os.path.join(self.path, content_hash[:2], content_hash[2:4],
+                            content_hash + '.z')
+
+    def put(self, content):
+        """Store content and return its hash."""
+        content_hash = self.get_hash(content)
+        path = self.get_path(content_hash)
+        if os.path.exists(path):
+            return content_hash
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, readers never see partial blobs
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as blob_file:
+                blob_file.write(zlib.compress(content, self.level))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return content_hash
+
+    def get(self, content_hash):
+        """Return the content or None if the blob is missing."""
+        try:
+            blob_file = open(self.get_path(content_hash), 'rb')
+        except FileNotFoundError:
+            return None
+        with blob_file:
+            if os.fstat(blob_file.fileno()).st_size == 0:
+                return b''
+            # Decompress straight from the mapped file without reading it first
+            with mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return zlib.decompress(mapped)
+
+    def delete(self, content_hash):
+        try:
+            os.unlink(self.get_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -1,16 +1,22 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import (Index, Column, Integer, String, Text, Boolean, DateTime,
-                        LargeBinary)
-from sqlalchemy import create_engine
+from sqlalchemy import (Index, Column, Integer, BigInteger, String, Text, Boolean,
+                        DateTime, LargeBinary)
+from sqlalchemy import create_engine, and_, or_, func, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
 
-from .base import BaseStorage, GeneratorWrapper as GW
+from .base import BaseStorage, GeneratorWrapper as GW, get_task_bucket
+from .blobs import BlobStore
 from ..utils import json_loads, json_dumps
 
 Base = declarative_base()
 
+# Stay below SQLite's default limit of 999 bound variables per statement
+SQL_VARIABLE_CHUNK = 500
+
 
 class Task(Base):
     __tablename__ = 'scrapa_task'
@@ -21,6 +27,7 @@ class Task(Base):
     name = Column(String)
     args = Column(Text)
     kwargs = Column(Text)
+    priority = Column(Integer, default=0)
     created = Column(DateTime)
     last_tried = Column(DateTime, nullable=True)
     tried = Column(Integer, default=0)
@@ -28,6 +35,10 @@ class Task(Base):
     failed = Column(Boolean, default=False)
     value = Column(Text, nullable=True)
     exception = Column(Text, nullable=True)
+    lease_owner = Column(String, nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    next_attempt = Column(DateTime, nullable=True)
+    bucket = Column(BigInteger, nullable=True)
 
     def __repr__(self):
         return "<Task(scraper_name='%s', taskid='%s', name='%s')>" % (
@@ -35,6 +46,9 @@ class Task(Base):
 
 Index('scraper_name_task_id', Task.scraper_name, Task.task_id, unique=True)
 
+# Rows stored before priorities existed have none
+TASK_PRIORITY = func.coalesce(Task.priority, 0)
+
 
 class Result(Base):
     __tablename__ = 'scrapa_result'
@@ -60,7 +74,16 @@ class Cache(Base):
     cache_id = Column(String, index=True, unique=True)
     url = Column(String)
     created = Column(DateTime)
-    content = Column(LargeBinary)
+    content = Column(LargeBinary, nullable=True)
+    content_hash = Column(String, index=True, nullable=True)
+    expires = Column(DateTime, nullable=True)
+    size = Column(Integer, default=0)
+    last_accessed = Column(DateTime, index=True)
+    hits = Column(Integer, default=0)
+    status = Column(Integer, default=200)
+    headers = Column(Text, nullable=True)
+    etag = Column(String, nullable=True)
+    last_modified = Column(String, nullable=True)
 
     def __repr__(self):
         return "<Cache(cache_id='%s', result_id='%s', kind='%s')>" % (
@@ -68,37 +91,160 @@ class Cache(Base):
 
 
 class DatabaseStorage(BaseStorage):
-    def __init__(self, db_url='sqlite:///:memory:'):
+    def __init__(self, db_url='sqlite:///:memory:', blob_path=None):
+        """
+        With blob_path cached content is stored compressed in files under
+        that directory instead of the database.
+        """
         self.db_url = db_url
+        if blob_path is not None:
+            self.blobs = BlobStore(blob_path)
 
     async def create(self):
         self.engine = create_engine(self.db_url, echo=False)
         Base.metadata.create_all(self.engine)
+        added = self.add_missing_columns()
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        if Task.__table__.c.bucket in added:
+            self.add_task_buckets()
+
+    def add_missing_columns(self):
+        """
+        Add columns (and their indexes) to tables created by older versions.
+        Returns the added columns.
+        """
+        inspector = inspect(self.engine)
+        added = []
+        for table in Base.metadata.sorted_tables:
+            existing = set(column['name'] for column in inspector.get_columns(table.name))
+            missing = [column for column in table.columns if column.name not in existing]
+            if not missing:
+                continue
+            added.extend(missing)
+            with self.engine.begin() as conn:
+                for column in missing:
+                    conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name,
+                        column.type.compile(dialect=self.engine.dialect))))
+                    if column.default is not None and column.default.is_scalar:
+                        conn.execute(text('UPDATE {0} SET {1} = :value'.format(
+                            table.name, column.name)), {'value': column.default.arg})
+            missing_names = set(column.name for column in missing)
+            for index in table.indexes:
+                if any(column.name in missing_names for column in index.columns):
+                    index.create(self.engine)
+        return added
+
+    def add_task_buckets(self):
+        """Compute the bucket of tasks stored before buckets existed."""
+        while True:
+            rows = (self.session.query(Task.id, Task.task_id)
+                    .filter(Task.bucket == None)  # noqa
+                    .limit(10000).all())
+            if not rows:
+                break
+            self.session.bulk_update_mappings(Task, [
+                {'id': row_id, 'bucket': get_task_bucket(task_id)}
+                for row_id, task_id in rows
+            ])
+            self.session.commit()
 
-    async def store_task(self, scraper_name, coro, args, kwargs):
-        task_id = self.get_task_id(coro, args, kwargs)
-        task_obj = self.session.query(Task
-                ).filter_by(scraper_name=scraper_name, task_id=task_id).first()
-        if not task_obj:
-            task = Task(
-                scraper_name=scraper_name,
-                task_id=task_id,
-                name=coro.__name__,
-                args=json_dumps(args),
-                kwargs=json_dumps(kwargs),
-                created=datetime.now(),
-                tried=0,
-                done=False,
-                failed=False,
-                value=None,
-                exception=None
-            )
-            self.session.add(task)
+    def get_task_row(self, scraper_name, task_id, coro, args, kwargs,
+                     priority=0, lease=None):
+        row = dict(
+            scraper_name=scraper_name,
+            task_id=task_id,
+            name=coro.__name__,
+            args=json_dumps(args),
+            kwargs=json_dumps(kwargs),
+            priority=priority,
+            created=datetime.now(),
+            tried=0,
+            done=False,
+            failed=False,
+            value=None,
+            exception=None,
+            bucket=get_task_bucket(task_id)
+        )
+        if lease is not None:
+            owner, duration = lease
+            row['lease_owner'] = owner
+            row['lease_expires'] = datetime.now() + timedelta(seconds=duration)
+        return row
+
+    async def store_task(self, scraper_name, coro, args, kwargs, priority=0,
+                         lease=None, task_id=None, is_new=False):
+        if task_id is None:
+            task_id = self.get_task_id(coro, args, kwargs)
+        if not is_new:
+            task_obj = self.session.query(Task
+                    ).filter_by(scraper_name=scraper_name, task_id=task_id).first()
+            if task_obj:
+                return False
+        task = Task(**self.get_task_row(scraper_name, task_id, coro, args,
+                                        kwargs, priority, lease))
+        self.session.add(task)
+        try:
             self.session.commit()
-            return True
-        return False
+        except IntegrityError:
+            # Stored by another worker in the meantime
+            self.session.rollback()
+            return False
+        return True
+
+    async def store_tasks(self, scraper_name, tasks, lease=None, new_task_ids=None):
+        rows = {}
+        for task in tasks:
+            task_id = self.get_record_id(task)
+            if task_id in rows:
+                continue
+            rows[task_id] = self.get_task_row(scraper_name, task_id, task.coro,
+                                              task.args, task.kwargs,
+                                              task.priority, lease)
+        task_ids = list(rows)
+        existing = set()
+        check_ids = task_ids
+        if new_task_ids is not None:
+            check_ids = [task_id for task_id in task_ids if task_id not in new_task_ids]
+        for i in range(0, len(check_ids), SQL_VARIABLE_CHUNK):
+            chunk = check_ids[i:i + SQL_VARIABLE_CHUNK]
+            existing.update(task_id for task_id, in self.session.query(Task.task_id).filter(
+                Task.scraper_name == scraper_name, Task.task_id.in_(chunk)))
+        new_rows = [row for task_id, row in rows.items() if task_id not in existing]
+        if not new_rows:
+            return set()
+        dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(self.engine.dialect.name)
+        if dialect is None:
+            return self.insert_task_rows(new_rows)
+        insert = dialect.insert(Task.__table__).on_conflict_do_nothing(
+            index_elements=[Task.scraper_name, Task.task_id])
+        self.session.execute(insert, new_rows)
+        self.session.commit()
+        # Rows stored by someone else in the meantime have another created date
+        stored = set()
+        new_ids = [row['task_id'] for row in new_rows]
+        for i in range(0, len(new_ids), SQL_VARIABLE_CHUNK):
+            chunk = new_ids[i:i + SQL_VARIABLE_CHUNK]
+            stored.update(task_id for task_id, created in self.session.query(
+                Task.task_id, Task.created).filter(
+                    Task.scraper_name == scraper_name, Task.task_id.in_(chunk))
+                if created == rows[task_id]['created'])
+        return stored
+
+    def insert_task_rows(self, rows):
+        """Insert rows one by one for databases without ON CONFLICT."""
+        stored = set()
+        insert = Task.__table__.insert()
+        for row in rows:
+            try:
+                with self.session.begin_nested():
+                    self.session.execute(insert, row)
+            except IntegrityError:
+                continue
+            stored.add(row['task_id'])
+        self.session.commit()
+        return stored
 
     async def clear_tasks(self, scraper_name):
         self.session.query(Task).filter_by(scraper_name=scraper_name).delete()
@@ -107,27 +253,101 @@ class DatabaseStorage(BaseStorage):
         return self.session.query(Task).filter_by(
                 scraper_name=scraper_name).count()
 
-    async def get_pending_task_count(self, scraper_name):
-        return self.session.query(Task).filter_by(
-                scraper_name=scraper_name, done=False).count()
-
-    async def get_pending_tasks(self, scraper_name):
+    async def get_pending_task_count(self, scraper_name, max_tries=None):
+        result = self.session.query(Task).filter_by(
+                scraper_name=scraper_name, done=False)
+        if max_tries is not None:
+            result = result.filter(func.coalesce(Task.tried, 0) < max_tries)
+        return result.count()
+
+    async def get_task_ids(self, scraper_name):
+        result = (self.session.query(Task.task_id)
+                    .filter_by(scraper_name=scraper_name)
+                    .yield_per(10000))
+        return GW(task_id for task_id, in result)
+
+    async def get_pending_tasks(self, scraper_name, after=None, limit=None,
+                                until=None, shard=None):
         result = self.session.query(Task).filter_by(scraper_name=scraper_name, done=False)
-        return GW({
-            'task_name': task.name,
-            'args': json_loads(task.args),
-            'kwargs': json_loads(task.kwargs),
-            'meta': {'tried': task.tried}
-        } for task in result)
+        if shard is not None:
+            index, count = shard
+            result = result.filter(Task.bucket % count == index)
+        if after is not None:
+            priority, task_id = after
+            result = result.filter(or_(
+                TASK_PRIORITY < priority,
+                and_(TASK_PRIORITY == priority, Task.id > task_id)
+            ))
+        if until is not None:
+            result = result.filter(Task.created <= until)
+        result = result.order_by(TASK_PRIORITY.desc(), Task.id)
+        if limit is not None:
+            result = result.limit(limit)
+        return GW(self.get_task_dict(task) for task in result)
+
+    async def lease_tasks(self, scraper_name, owner, limit, duration, max_tries=None):
+        now = datetime.now()
+        expires = now + timedelta(seconds=duration)
+        available = and_(
+            Task.scraper_name == scraper_name,
+            Task.done == False,  # noqa
+            or_(Task.lease_expires == None, Task.lease_expires < now),  # noqa
+            or_(Task.next_attempt == None, Task.next_attempt <= now)  # noqa
+        )
+        if max_tries is not None:
+            available = and_(available, func.coalesce(Task.tried, 0) < max_tries)
+        task_ids = [task_id for task_id, in self.session.query(Task.id)
+                    .filter(available)
+                    .order_by(TASK_PRIORITY.desc(), Task.id)
+                    .limit(limit)]
+        if not task_ids:
+            return []
+        # Check availability again in the update so that concurrent
+        # leasers can't take the same tasks
+        (self.session.query(Task)
+                    .filter(Task.id.in_(task_ids), available)
+                    .update({'lease_owner': owner, 'lease_expires': expires},
+                            synchronize_session=False))
+        self.session.commit()
+        result = (self.session.query(Task)
+                    .filter(Task.id.in_(task_ids),
+                            Task.lease_owner == owner,
+                            Task.lease_expires == expires)
+                    .order_by(TASK_PRIORITY.desc(), Task.id))
+        return [self.get_task_dict(task) for task in result]
+
+    async def renew_leases(self, scraper_name, owner, duration):
+        (self.session.query(Task)
+                    .filter_by(scraper_name=scraper_name, lease_owner=owner)
+                    .update({'lease_expires': datetime.now() + timedelta(seconds=duration)}))
+        self.session.commit()
+
+    async def release_leases(self, scraper_name, owner):
+        (self.session.query(Task)
+                    .filter_by(scraper_name=scraper_name, lease_owner=owner)
+                    .update({'lease_owner': None, 'lease_expires': None}))
+        self.session.commit()
 
     async def store_task_result(self, scraper_name, coro, args, kwargs, done, failed,
-                          value, exception):
-        task_id = self.get_task_id(coro, args, kwargs)
+                          value, exception, task_id=None):
+        if task_id is None:
+            task_id = self.get_task_id(coro, args, kwargs)
         (self.session.query(Task)
                     .filter_by(scraper_name=scraper_name, task_id=task_id)
                     .update({'done': done, 'failed': failed,
                             'last_tried': datetime.now(), 'value': json_dumps(value),
-                            'exception': exception, 'tried': Task.tried + 1}))
+                            'exception': exception, 'tried': Task.tried + 1,
+                            'lease_owner': None, 'lease_expires': None,
+                            'next_attempt': None}))
+        self.session.commit()
+
+    async def store_task_retry(self, scraper_name, coro, args, kwargs,
+                               next_attempt, task_id=None):
+        if task_id is None:
+            task_id = self.get_task_id(coro, args, kwargs)
+        (self.session.query(Task)
+                    .filter_by(scraper_name=scraper_name, task_id=task_id)
+                    .update({'next_attempt': next_attempt}))
         self.session.commit()
 
     async def has_result(self, scraper_name, result_id, kind):
@@ -164,16 +384,99 @@ class DatabaseStorage(BaseStorage):
         return has_result
 
     async def get_cached_content(self, cache_id):
+        now = datetime.now()
+        cached = self.session.query(Cache).filter_by(cache_id=cache_id).first()
+        if cached is None or (cached.expires is not None and cached.expires <= now):
+            return None
+        cached.last_accessed = now
+        cached.hits = (cached.hits or 0) + 1
+        self.session.commit()
+        return self.get_cache_content(cached)
+
+    async def get_cache_entry(self, cache_id):
         cached = self.session.query(Cache).filter_by(cache_id=cache_id).first()
-        if cached:
-            return cached.content
-        return None
-
-    async def set_cached_content(self, cache_id, url, content):
-        self.session.add(Cache(cache_id=cache_id, url=url,
-                               content=content,
-                               created=datetime.now()))
+        if cached is None:
+            return None
+        cached.last_accessed = datetime.now()
+        cached.hits = (cached.hits or 0) + 1
         self.session.commit()
+        cache_dict = self.get_cache_dict(cached)
+        if cache_dict['content'] is None:
+            # Blob went missing
+            return None
+        return cache_dict
+
+    async def set_cached_content(self, cache_id, url, content, expires=None,
+                                 status=200, headers=None, etag=None,
+                                 last_modified=None):
+        now = datetime.now()
+        cached = self.session.query(Cache).filter_by(cache_id=cache_id).first()
+        if cached is None:
+            cached = Cache(cache_id=cache_id)
+            self.session.add(cached)
+        old_hash = cached.content_hash
+        if self.blobs is not None:
+            cached.content = None
+            cached.content_hash = self.blobs.put(content)
+        else:
+            cached.content = content
+            cached.content_hash = None
+        cached.url = url
+        cached.created = now
+        cached.expires = expires
+        cached.size = len(content)
+        cached.last_accessed = now
+        cached.hits = 0
+        cached.status = status
+        cached.headers = json_dumps(headers) if headers is not None else None
+        cached.etag = etag
+        cached.last_modified = last_modified
+        self.session.commit()
+        if old_hash != cached.content_hash:
+            self.delete_unused_blobs([old_hash])
+
+    def delete_unused_blobs(self, content_hashes):
+        if self.blobs is None:
+            return
+        for content_hash in set(content_hashes) - {None}:
+            used = (self.session.query(Cache.id)
+                                .filter_by(content_hash=content_hash).first())
+            if used is None:
+                self.blobs.delete(content_hash)
+
+    async def touch_cached_content(self, cache_id, expires=None):
+        (self.session.query(Cache)
+                     .filter_by(cache_id=cache_id)
+                     .update({'expires': expires, 'last_accessed': datetime.now()}))
+        self.session.commit()
+
+    async def evict_cache(self, max_size=0, policy='lru', limit=100):
+        query = self.session.query(Cache.id)
+        # Expired entries with validators are kept for revalidation
+        expired = [cache_pk for cache_pk, in query.filter(
+            Cache.expires != None, Cache.expires <= datetime.now(),  # noqa
+            Cache.etag == None, Cache.last_modified == None  # noqa
+        ).limit(limit)]
+        if max_size:
+            total_size = self.session.query(func.sum(Cache.size)).scalar() or 0
+            if total_size > max_size:
+                if policy == 'lfu':
+                    order = (Cache.hits, Cache.last_accessed)
+                else:
+                    order = (Cache.last_accessed,)
+                expired += [cache_pk for cache_pk, in query.order_by(*order).limit(limit)]
+        expired = set(expired)
+        if expired:
+            content_hashes = [content_hash for content_hash, in
+                              self.session.query(Cache.content_hash)
+                                          .filter(Cache.id.in_(expired))]
+            (self.session.query(Cache).filter(Cache.id.in_(expired))
+                         .delete(synchronize_session=False))
+            self.session.commit()
+            self.delete_unused_blobs(content_hashes)
+        return len(expired)
 
     async def clear_cache(self):
+        if self.blobs is not None:
+            self.blobs.clear()
         self.session.query(Cache).delete()
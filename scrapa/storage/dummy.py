@@ -5,7 +5,8 @@ class DummyStorage(BaseStorage):
     async def create(self):
         pass
 
-    async def store_task(self, scraper_name, coro, args, kwargs):
+    async def store_task(self, scraper_name, coro, args, kwargs, priority=0,
+                         lease=None, task_id=None, is_new=False):
         return True
 
     async def clear_tasks(self, scraper_name):
@@ -14,16 +15,33 @@ class DummyStorage(BaseStorage):
     async def get_task_count(self, scraper_name):
         return 0
 
-    async def get_pending_task_count(self, scraper_name):
+    async def get_pending_task_count(self, scraper_name, max_tries=None):
         return 0
 
-    async def get_pending_tasks(self, scraper_name):
+    async def get_task_ids(self, scraper_name):
         return []
 
+    async def get_pending_tasks(self, scraper_name, after=None, limit=None,
+                                until=None, shard=None):
+        return []
+
+    async def lease_tasks(self, scraper_name, owner, limit, duration, max_tries=None):
+        return []
+
+    async def renew_leases(self, scraper_name, owner, duration):
+        pass
+
+    async def release_leases(self, scraper_name, owner):
+        pass
+
     async def store_task_result(self, scraper_name, coro, args, kwargs, done, failed,
-                          value, exception):
+                          value, exception, task_id=None):
         return False
 
+    async def store_task_retry(self, scraper_name, coro, args, kwargs,
+                               next_attempt, task_id=None):
+        pass
+
     async def has_result(self, scraper_name, result_id, kind):
         return False
 
@@ -36,8 +54,19 @@ class DummyStorage(BaseStorage):
     async def get_cached_content(self, cache_id):
         pass
 
-    async def set_cached_content(self, cache_id, url, content):
+    async def get_cache_entry(self, cache_id):
+        return None
+
+    async def set_cached_content(self, cache_id, url, content, expires=None,
+                                 status=200, headers=None, etag=None,
+                                 last_modified=None):
         pass
 
+    async def touch_cached_content(self, cache_id, expires=None):
+        pass
+
+    async def evict_cache(self, max_size=0, policy='lru', limit=100):
+        return 0
+
     async def clear_cache(self):
         pass
@@ -0,0 +1,22 @@
+class Task():
+    """
+    A call of a task function on its way from scheduling to completion.
+    The task id of stored tasks is computed once and then carried along
+    with the attempt count and priority.
+    """
+    __slots__ = ('coro', 'args', 'kwargs', 'task_id', 'tried', 'priority')
+
+    def __init__(self, coro, args, kwargs, task_id=None, tried=0, priority=0):
+        self.coro = coro
+        self.args = args
+        self.kwargs = kwargs
+        self.task_id = task_id
+        self.tried = tried
+        self.priority = priority
+
+    @property
+    def name(self):
+        return self.coro.__name__
+
+    def __repr__(self):
+        return '<Task {}(*{}, **{})>'.format(self.name, self.args, self.kwargs)
@@ -0,0 +1,331 @@
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import time
+from urllib.parse import urlsplit
+
+
+MAX_BACKOFF = 300
+
+
+def get_backoff(attempt, base, maximum):
+    """Exponential backoff with full jitter for the given attempt number."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """
+    Return the number of seconds a Retry-After header value asks us to
+    wait or None if it can't be parsed. The header is either a number of
+    seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_date is None:
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max((retry_date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class ConcurrencyLimiter():
+    """
+    Like asyncio.Semaphore, but the limit can be changed while it is in
+    use. A limit of 0 means no limit.
+    """
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.active = 0
+        self._waiters = deque()
+
+    def has_capacity(self):
+        return not self.limit or self.active < self.limit
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake_up()
+
+    async def acquire(self):
+        if not self._waiters and self.has_capacity():
+            self.active += 1
+            return
+        waiter = asyncio.Future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was handed over just before the cancellation
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        while self._waiters and self.has_capacity():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AdaptiveLimiter(ConcurrencyLimiter):
+    """
+    ConcurrencyLimiter that adjusts its limit with AIMD: the limit grows
+    by one per window of healthy requests and is cut by decrease_factor
+    on errors or when latency rises above latency_factor times the
+    lowest latency seen.
+    """
+    def __init__(self, limit, min_limit=1, max_limit=100, latency_factor=2.0,
+                 decrease_factor=0.5):
+        if min_limit < 1:
+            # A limit of 0 would mean no limit at all
+            raise ValueError('min_limit must be at least 1')
+        limit = min(max(limit, min_limit), max_limit)
+        super(AdaptiveLimiter, self).__init__(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.window = float(limit)
+        self.latency = None
+        self.base_latency = None
+        self.last_decrease = 0
+
+    def record(self, latency, error=False):
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if self.base_latency is None:
+                self.base_latency = self.latency
+            else:
+                # Let the baseline drift up slowly so it can follow a
+                # host that got permanently slower
+                self.base_latency = min(self.latency, self.base_latency * 1.001)
+        congested = error or (
+            self.base_latency and
+            self.latency > self.base_latency * self.latency_factor
+        )
+        if congested:
+            now = time.monotonic()
+            # Requests that were in flight during the congestion all fail
+            # together, only cut the limit once per round trip
+            if now - self.last_decrease > (self.latency or 0):
+                self.window = max(self.min_limit, self.window * self.decrease_factor)
+                self.last_decrease = now
+        else:
+            self.window = min(self.max_limit, self.window + 1 / self.window)
+        self.set_limit(int(self.window))
+
+
+class TokenBucket():
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """
+        Take one token and return the number of seconds to wait until it
+        may be used. Tokens can go into debt so that concurrent callers
+        queue up behind each other.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def has_token(self):
+        """Whether reserve() would return without a delay."""
+        now = time.monotonic()
+        return min(self.burst, self.tokens + (now - self.updated) * self.rate) >= 1
+
+
+class HostThrottle():
+    """
+    Concurrency cap and rate limit for a single host. Use it as an async
+    context manager around each request to that host.
+    """
+    def __init__(self, host, concurrency=0, rate=0, burst=1, adaptive=None):
+        self.host = host
+        if adaptive is not None:
+            self.limiter = AdaptiveLimiter(concurrency or adaptive['max_limit'],
+                                           **adaptive)
+        else:
+            self.limiter = ConcurrencyLimiter(concurrency)
+        self.rate = rate
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.blocked_until = 0
+        self.backoff_count = 0
+        self.last_used = time.monotonic()
+
+    def is_ready(self):
+        """Whether a request could start right away."""
+        if not self.limiter.has_capacity():
+            return False
+        if self.blocked_until > time.monotonic():
+            return False
+        return self.bucket is None or self.bucket.has_token()
+
+    def is_idle(self, idle_time):
+        """Whether the throttle holds no state worth keeping."""
+        now = time.monotonic()
+        return (self.limiter.active == 0 and self.blocked_until <= now and
+                now - self.last_used >= idle_time)
+
+    def get_delay(self):
+        delay = self.blocked_until - time.monotonic()
+        if self.bucket is not None:
+            delay = max(delay, self.bucket.reserve())
+        return max(delay, 0)
+
+    async def acquire(self):
+        self.last_used = time.monotonic()
+        await self.limiter.acquire()
+        try:
+            delay = self.get_delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.limiter.release()
+            raise
+
+    def release(self):
+        self.last_used = time.monotonic()
+        self.limiter.release()
+
+    def slow_down(self, retry_after=None):
+        """
+        Called when the host asked us to back off. Blocks the host for
+        retry_after seconds (or an exponential backoff if not given) and
+        halves its request rate.
+        """
+        self.backoff_count += 1
+        if retry_after is None:
+            retry_after = min(2 ** self.backoff_count, MAX_BACKOFF)
+        self.blocked_until = max(self.blocked_until,
+                                 time.monotonic() + retry_after)
+        if self.bucket is not None:
+            self.bucket.rate = max(self.bucket.rate / 2, self.rate / 16)
+
+    def speed_up(self):
+        """Slowly recover the configured rate after a successful request."""
+        self.backoff_count = 0
+        if self.bucket is not None and self.bucket.rate < self.rate:
+            self.bucket.rate = min(self.rate, self.bucket.rate + self.rate / 10)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class RequestSlots():
+    """
+    Host and global slot of one request. After detach() the slots are kept
+    when the async with block ends, release() gives them back.
+    """
+    def __init__(self, host_throttle, limiter):
+        self.host_throttle = host_throttle
+        self.limiter = limiter
+        self.held = False
+        self.detached = False
+
+    def detach(self):
+        self.detached = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.limiter.release()
+            self.host_throttle.release()
+
+    async def __aenter__(self):
+        await self.host_throttle.acquire()
+        try:
+            await self.limiter.acquire()
+        except BaseException:
+            self.host_throttle.release()
+            raise
+        self.held = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.detached:
+            self.release()
+
+
+class HostScheduler():
+    """
+    Hands out a HostThrottle per host. host_limits maps a host name to a
+    dict with 'concurrency', 'rate' and 'burst' keys that override the
+    defaults for that host. adaptive is a dict of AdaptiveLimiter keyword
+    arguments to adapt the concurrency of every host. Throttles of hosts
+    that were idle for idle_time seconds are dropped once there are more
+    than max_hosts.
+    """
+    def __init__(self, concurrency=0, rate=0, burst=1, host_limits=None,
+                 adaptive=None, max_hosts=10000, idle_time=300):
+        self.defaults = {
+            'concurrency': concurrency,
+            'rate': rate,
+            'burst': burst,
+            'adaptive': adaptive
+        }
+        self.host_limits = host_limits or {}
+        self.hosts = {}
+        self.max_hosts = max_hosts
+        self.idle_time = idle_time
+        self.next_expiry = 0
+
+    def get_host(self, url):
+        return urlsplit(url).netloc.lower()
+
+    def is_ready(self, host):
+        throttle = self.hosts.get(host)
+        return throttle is None or throttle.is_ready()
+
+    def expire_hosts(self):
+        for host, throttle in list(self.hosts.items()):
+            if throttle.is_idle(self.idle_time):
+                del self.hosts[host]
+
+    def get_throttle(self, url):
+        host = self.get_host(url)
+        if host not in self.hosts:
+            now = time.monotonic()
+            if self.max_hosts and len(self.hosts) >= self.max_hosts and now >= self.next_expiry:
+                self.expire_hosts()
+                # Don't scan all hosts again for every new host
+                self.next_expiry = now + min(self.idle_time, 60)
+            limits = dict(self.defaults)
+            limits.update(self.host_limits.get(host, {}))
+            self.hosts[host] = HostThrottle(host, **limits)
+        return self.hosts[host]
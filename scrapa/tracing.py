@@ -0,0 +1,129 @@
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+
+from .utils import json_dumps
+
+
+PHASES = ('queue', 'dns', 'connect', 'ttfb', 'body', 'total')
+
+# Upper bucket bounds in milliseconds
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                    10000, 30000, 60000, float('inf'))
+
+
+def get_body_size(body):
+    """Size of a request body in bytes, None for streams."""
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, (list, tuple)) and all(isinstance(b, bytes) for b in body):
+        return sum(len(b) for b in body)
+    return None
+
+
+def make_request_trace(connect_trace, started, headers_received, body_read=None):
+    """
+    Split the time of a request into phases (in seconds). connect_trace
+    holds the queue, dns and connect times recorded by the connector.
+    """
+    connect_trace = connect_trace or {}
+    trace = {
+        'queue': connect_trace.get('queue', 0.0),
+        'dns': connect_trace.get('dns', 0.0),
+        'connect': connect_trace.get('connect', 0.0),
+        'reused': connect_trace.get('reused'),
+        'body': None
+    }
+    trace['ttfb'] = max(0.0, headers_received - started -
+                        trace['queue'] - trace['dns'] - trace['connect'])
+    end = headers_received
+    if body_read is not None:
+        trace['body'] = body_read - headers_received
+        end = body_read
+    trace['total'] = end - started
+    return trace
+
+
+class LatencyHistogram():
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.buckets[bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile in ms."""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 1)
+        return round(self.max, 1)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 1) if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': round(self.max, 1),
+            'buckets': OrderedDict(
+                (str(bound), count) for bound, count in zip(self.bounds, self.buckets)
+                if count
+            )
+        }
+
+
+class HostTrace():
+    def __init__(self):
+        self.phases = {phase: LatencyHistogram() for phase in PHASES}
+        self.counter = Counter()
+
+    def add(self, trace, bytes_in=None, bytes_out=None):
+        for phase in PHASES:
+            if trace.get(phase) is not None:
+                self.phases[phase].add(trace[phase])
+        self.counter['requests'] += 1
+        if trace.get('reused'):
+            self.counter['reused'] += 1
+        self.counter['bytes_in'] += bytes_in or 0
+        self.counter['bytes_out'] += bytes_out or 0
+
+    def to_dict(self):
+        info = dict(self.counter)
+        info['phases'] = {phase: hist.to_dict() for phase, hist in self.phases.items()}
+        return info
+
+
+class RequestTracer():
+    """Per host latency histograms of request phases."""
+    def __init__(self):
+        self.hosts = {}
+
+    def add(self, host, trace, bytes_in=None, bytes_out=None):
+        if host not in self.hosts:
+            self.hosts[host] = HostTrace()
+        self.hosts[host].add(trace, bytes_in=bytes_in, bytes_out=bytes_out)
+
+    def get_summary(self):
+        return {host: host_trace.to_dict()
+                for host, host_trace in sorted(self.hosts.items())}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(json_dumps(self.get_summary()))
@@ -5,7 +5,7 @@ import functools
 import hashlib
 from itertools import repeat
 import json
-from urllib.parse import urlsplit, parse_qsl
+from urllib.parse import urlsplit, urlunsplit, urlencode, parse_qsl
 import webbrowser
 
 import aiohttp
@@ -52,10 +52,28 @@ class CustomEncoder(json.JSONEncoder):
             return {
                 k: obj.getall(k) for k in obj
             }
+        elif isinstance(obj, Payload):
+            return obj.encode()
         else:
             return super(CustomEncoder, self).default(obj)
 
 
+class Payload():
+    """
+    Captured response body that is only base64 encoded when a log handler
+    serializes it.
+    """
+    __slots__ = ('content',)
+
+    def __init__(self, content, max_bytes=None):
+        if max_bytes is not None and len(content) > max_bytes:
+            content = content[:max_bytes]
+        self.content = content
+
+    def encode(self):
+        return base64.b64encode(self.content).decode('utf-8')
+
+
 def json_dumps(obj, indent=2):
     return json.dumps(obj, cls=CustomEncoder, indent=indent, sort_keys=True)
 
@@ -96,11 +114,70 @@ def add_func_to_iterator(coro_arg, iterator):
     yield from zip(coro_iter, iterator)
 
 
-def get_cache_id(url, *args, **kwargs):
-    cache_id = hashlib.md5()
-    cache_id.update(url.encode('utf-8'))
-    cache_id.update(json.dumps(kwargs.get('params', ''), sort_keys=True).encode('utf-8'))
-    return cache_id.hexdigest()
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def get_sorted_pairs(pairs):
+    if hasattr(pairs, 'items'):
+        pairs = pairs.items()
+    return sorted((str(k), str(v)) for k, v in pairs)
+
+
+def canonicalize_url(url, params=None):
+    """
+    Lower case scheme and host, drop default ports and the fragment and
+    sort the query string (with params merged in).
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, parts.port)
+    if parts.username is not None:
+        netloc = '{}@{}'.format(parts.username, netloc)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        query += get_sorted_pairs(params)
+    return urlunsplit((scheme, netloc, parts.path or '/',
+                       urlencode(get_sorted_pairs(query)), ''))
+
+
+def get_body_fingerprint(data=None, json_data=None):
+    """Return bytes that identify the request body or None if unknown."""
+    if json_data is not None:
+        return json.dumps(json_data, sort_keys=True).encode('utf-8')
+    if data is None:
+        return b''
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    if hasattr(data, 'items') or isinstance(data, (list, tuple)):
+        return urlencode(get_sorted_pairs(data)).encode('utf-8')
+    # Streams, multipart writers etc.
+    return None
+
+
+def get_request_fingerprint(method, url, params=None, data=None, json_data=None,
+                            headers=None, key_headers=()):
+    """
+    Hash of method, canonical URL, body and the values of the key_headers
+    of a request. Returns None if the body can't be fingerprinted.
+    """
+    body = get_body_fingerprint(data=data, json_data=json_data)
+    if body is None:
+        return None
+    fingerprint = hashlib.md5()
+    fingerprint.update(method.upper().encode('utf-8'))
+    fingerprint.update(b'\n')
+    fingerprint.update(canonicalize_url(url, params=params).encode('utf-8'))
+    fingerprint.update(b'\n')
+    fingerprint.update(body)
+    if key_headers:
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        for name in sorted(h.lower() for h in key_headers):
+            fingerprint.update('\n{}: {}'.format(name, headers.get(name, '')).encode('utf-8'))
+    return fingerprint.hexdigest()
 
 
 def doublewrap(f):
@@ -140,6 +217,30 @@ def store(f, exclude=()):
     return asyncio.coroutine(f)
 
 
+@doublewrap
+def limit(f, concurrency=0, weight=1):
+    """
+    Run at most concurrency queued tasks of this function at the same time
+    (0 means no limit). The weight sets the share of consumer slots the
+    function gets relative to other task functions.
+    """
+    if weight <= 0:
+        raise ValueError('Task weight must be positive')
+    f.task_concurrency = concurrency
+    f.task_weight = weight
+    return f
+
+
+@doublewrap
+def deadline(f, seconds):
+    """
+    Cancel the task if it runs longer than seconds, overrides TASK_TIMEOUT.
+    None disables the deadline for this function.
+    """
+    f.task_timeout = seconds
+    return f
+
+
 def get_url_parts(url):
     url_parts = urlsplit(url)
     url_dict = vars(url_parts)
@@ -0,0 +1,175 @@
+import asyncio
+from collections import Counter
+import multiprocessing
+import queue
+import signal
+import time
+
+from .storage.base import get_task_bucket
+
+
+class WorkerMixin():
+    """
+    Runs a scraper in several processes. Stored tasks are split between
+    workers by their task id (or leased with TASK_LEASING), every worker
+    runs its own event loop and session pool. The parent process seeds
+    the tasks, then only aggregates the progress reported by the workers.
+
+    Workers share the storage, so use a database that handles concurrent
+    writers well (e.g. Postgres).
+    """
+    worker_index = 0
+    worker_count = 1
+    worker_busy = True
+    busy_workers = None
+    worker_stats_queue = None
+
+    def owns_task(self, task_id):
+        """Return True if this process should run the stored task."""
+        if self.worker_count == 1:
+            return True
+        if self.worker_index is None:
+            # Seeding parent leaves stored tasks to the workers
+            return False
+        if self.config.TASK_LEASING:
+            # New tasks are leased to whoever stored them
+            return True
+        return get_task_bucket(task_id) % self.worker_count == self.worker_index
+
+    def get_task_shard(self):
+        """Part of the pending tasks this process reads from storage."""
+        if self.worker_count == 1 or self.worker_index is None:
+            return None
+        return (self.worker_index, self.worker_count)
+
+    def is_worker(self):
+        return self.worker_count > 1 and self.worker_index is not None
+
+    def scrape_workers(self, worker_count, **kwargs):
+        self.worker_index = None
+        self.worker_count = worker_count
+        self.init_configuration(dict(kwargs, enable_webserver=False))
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(self.check_start(**kwargs))
+        finally:
+            loop.close()
+
+        context = multiprocessing.get_context('fork')
+        self.busy_workers = context.Value('i', worker_count)
+        self.worker_stats_queue = context.Queue()
+        workers = [
+            context.Process(target=self.run_worker, args=(i, kwargs))
+            for i in range(worker_count)
+        ]
+        self.logger.info('Starting %d workers', worker_count)
+        for worker in workers:
+            worker.start()
+        try:
+            self.wait_for_workers(workers)
+        except KeyboardInterrupt:
+            self.logger.info('Stopping workers...')
+            for worker in workers:
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+        self.logger.info('Done.')
+
+    def run_worker(self, worker_index, kwargs):
+        # The parent handles interrupts and terminates the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.worker_index = worker_index
+        kwargs = dict(kwargs)
+        for key in ('start', 'clear', 'clear_cache'):
+            kwargs.pop(key, None)
+        if worker_index > 0:
+            kwargs['enable_webserver'] = False
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.init_configuration(kwargs)
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(self.start_worker(**kwargs))
+        finally:
+            self.report_worker_stats()
+            self.set_worker_busy(False)
+            loop.close()
+
+    async def start_worker(self, **kwargs):
+        """Workers never seed, they only run the tasks stored by the parent."""
+        await self.get_storage()
+        self.configure(**kwargs)
+        await self.resume()
+
+    def set_worker_busy(self, busy):
+        if not self.is_worker() or busy == self.worker_busy:
+            return
+        self.worker_busy = busy
+        with self.busy_workers.get_lock():
+            self.busy_workers.value += 1 if busy else -1
+
+    async def can_stop_worker(self):
+        """
+        Called when this process has no queued or running tasks left.
+        A worker may only stop when no other worker is busy (and could
+        still store tasks for it) and no pending tasks are left at all.
+        """
+        if not self.is_worker():
+            return True
+        self.set_worker_busy(False)
+        if self.busy_workers.value > 0:
+            return False
+        storage = await self.get_storage()
+        max_tries = None
+        if self.config.TASK_LEASING:
+            # Leased tasks that used up their retries are never leased again
+            max_tries = self.config.TASK_RETRY_COUNT
+        pending_count = await storage.get_pending_task_count(self.config.NAME,
+                                                             max_tries=max_tries)
+        return pending_count == 0
+
+    def report_worker_stats(self):
+        if not self.is_worker() or not hasattr(self, 'stats'):
+            return
+        self.worker_stats_queue.put({
+            'worker': self.worker_index,
+            'counter': dict(self.stats['counter']),
+            'queue_size': self.queue.qsize(),
+            'running': self.tasks_running
+        })
+
+    def wait_for_workers(self, workers):
+        worker_stats = {}
+        last_log = time.monotonic()
+        while any(worker.is_alive() for worker in workers):
+            try:
+                stats = self.worker_stats_queue.get(timeout=1)
+                worker_stats[stats['worker']] = stats
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_log >= self.config.PROGRESS_INTERVAL:
+                self.log_worker_stats(worker_stats)
+                last_log = time.monotonic()
+        while True:
+            try:
+                stats = self.worker_stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            worker_stats[stats['worker']] = stats
+        self.log_worker_stats(worker_stats)
+
+    def log_worker_stats(self, worker_stats):
+        counter = Counter()
+        queued = 0
+        running = 0
+        for stats in worker_stats.values():
+            counter.update(stats['counter'])
+            queued += stats['queue_size']
+            running += stats['running']
+        self.logger.info('{success}/{tried} tasks succeeded out of {queued} '
+                         '(running: {running}) in {workers} workers'.format(
+            success=counter['tasks_succeeded'],
+            tried=counter['tasks_tried'],
+            queued=queued,
+            running=running,
+            workers=len(worker_stats)
+        ))